@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Compare the scandir based `flister` against the previous glob based
+implementation on a synthetic tree.
+
+usage: python benchmarks/bench_flister.py [ndirs] [nfiles_per_dir]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import itertools
+
+from os.path import *
+from glob import iglob
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from vacuum.utils import flister, is_older_than, pastdt, str2re
+
+
+def glob_flister(rootdir=None, patterns=None, older_than=None, recursive=False,
+                 max_depth=-1, depth=1, date_strptime=None, time_strptime=None,
+                 now=None, include_hidden=True, **kwargs):
+    """ `flister` as it was before the scandir engine """
+    rootdir = rootdir or abspath('.')
+    if not isinstance(patterns, (tuple,list)):
+        patterns = [patterns or '.+']
+
+    compiled = str2re(patterns)
+
+    than = pastdt(older_than, now=now) if older_than is not None else None
+
+    if include_hidden:
+        all_files = itertools.chain(iglob(join(rootdir,'*')),
+                                    iglob(join(rootdir,'.*')))
+    else:
+        all_files = iglob(join(rootdir,'*'))
+
+    for filepath in all_files:
+        filename = basename(filepath)
+        for pattern in compiled:
+            if isfile(filepath) and pattern.match(filename) and \
+               is_older_than(filepath, than, date_strptime, time_strptime):
+                yield filepath
+            elif islink(filepath) and pattern.match(filename):
+                yield filepath
+            elif isdir(filepath) and recursive and \
+                (max_depth == -1 or depth < max_depth):
+                i = 0
+                for filepath_ in glob_flister(filepath, patterns, older_than,
+                                              recursive, max_depth,
+                                              depth+1,date_strptime,
+                                              time_strptime):
+                    yield filepath_
+                    i += 1
+                if i == 0 and exists(filepath) and not os.listdir(filepath):
+                    yield filepath
+
+
+def make_tree(rootdir, ndirs, nfiles):
+    for d in range(ndirs):
+        dirpath = join(rootdir, 'cycle%04d' % d, 'output')
+        os.makedirs(dirpath)
+        for f in range(nfiles):
+            open(join(dirpath, 'file%05d.nc' % f), 'w').close()
+
+
+def timeit(func, repeat=3, **kwargs):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        nfiles = sum(1 for _ in func(**kwargs))
+        elapsed = time.time()-start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, nfiles
+
+
+def main(ndirs=100, nfiles=200):
+    rootdir = tempfile.mkdtemp()
+    try:
+        make_tree(rootdir, ndirs, nfiles)
+        options = dict(rootdir=rootdir, patterns=[r'.+\.nc$'], recursive=True,
+                       older_than='0s')
+        print('Tree with %d directories and %d files' % (ndirs*2, ndirs*nfiles))
+        for name, func in [('glob', glob_flister), ('scandir', flister)]:
+            elapsed, found = timeit(func, **options)
+            print('%-8s %8.3fs %10d files' % (name, elapsed, found))
+    finally:
+        shutil.rmtree(rootdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:3]])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Time matching the tags of a synthetic registry snapshot against the ignore
+patterns of a scrub rule: the previous `_not_matches_ignores` (compiling
+every pattern for each image) vs the rule `IgnoreMatcher`.
+
+usage: python benchmarks/bench_ignores.py [nimages] [nignores]
+"""
+import re
+import sys
+import time
+import random
+
+from os.path import *
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from vacuum.scrub import IgnoreMatcher
+
+
+def legacy_not_matches_ignores(ignores, names):
+    """ `WhaleScrubber._not_matches_ignores` as it was before `IgnoreMatcher` """
+    if not isinstance(names, (list,tuple)):
+        names = [names]
+    not_matches = True
+    for ignore in ignores:
+        reignore = re.compile(ignore)
+        for name in names:
+            if reignore.match(name):
+                return False
+    return not_matches
+
+
+def make_snapshot(nimages, seed=0):
+    """ Tags of `nimages` images, many sharing repositories (and tags) """
+    rand = random.Random(seed)
+    snapshot = []
+    for i in range(nimages):
+        repo = 'org%d/repo%d' % (rand.randint(0, 20), rand.randint(0, 200))
+        snapshot.append(['%s:%s' % (repo, tag) for tag in
+                                        ['v%d' % rand.randint(0, 50), 'latest'][:rand.randint(0, 2)]])
+    return snapshot
+
+
+def timeit(func, snapshot, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        kept = sum(1 for tags in snapshot if not func(tags))
+        elapsed = time.time()-start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, kept
+
+
+def main(nimages=10000, nignores=20):
+    snapshot = make_snapshot(nimages)
+    ignores = ['org%d/.+' % i for i in range(nignores//2)]
+    ignores += [r'org\d+/repo%d:v\d+' % i for i in range(nignores-nignores//2)]
+    print('Snapshot of %d images, %d ignore patterns' % (nimages, len(ignores)))
+    matcher = IgnoreMatcher(ignores)
+    for name, func in [('legacy', lambda tags: legacy_not_matches_ignores(ignores, tags)),
+                       ('matcher', lambda tags: not matcher.matches(tags))]:
+        elapsed, kept = timeit(func, snapshot)
+        print('%-8s %8.3fs %10d images not ignored' % (name, elapsed, kept))
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:3]])
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Scan time of `flister` as the number of patterns of a rule grows, it should
+stay flat while the previous glob implementation re-recursed once per pattern
+at every level (growing as npatterns**depth).
+
+usage: python benchmarks/bench_patterns.py [ndirs] [nfiles_per_dir]
+"""
+import sys
+import shutil
+import tempfile
+
+from os.path import *
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from vacuum.utils import flister
+from bench_flister import glob_flister, make_tree, timeit
+
+
+def main(ndirs=10, nfiles=100):
+    rootdir = tempfile.mkdtemp()
+    try:
+        make_tree(rootdir, ndirs, nfiles)
+        print('Tree with %d directories and %d files' % (ndirs*2, ndirs*nfiles))
+        print('%-9s %10s %10s' % ('patterns', 'glob', 'scandir'))
+        for npatterns in [1, 2, 4, 8]:
+            patterns = [r'file%05d\.nc$' % i for i in range(npatterns-1)]
+            patterns.append(r'.+\.nc$')
+            options = dict(rootdir=rootdir, patterns=patterns, recursive=True)
+            glob_elapsed, glob_found = timeit(glob_flister, **options)
+            elapsed, found = timeit(flister, **options)
+            print('%-9d %9.3fs %9.3fs  (%d vs %d files)' %\
+                        (npatterns, glob_elapsed, elapsed, glob_found, found))
+    finally:
+        shutil.rmtree(rootdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:3]])
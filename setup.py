@@ -24,6 +24,8 @@ def get_requirements(filename):
 install_requires = get_requirements('requirements/default.txt')
 if sys.version_info < (3, 0):
     install_requires.append('futures')
+if sys.version_info < (3, 5):
+    install_requires.append('scandir')
 
 setup(name='vacuum',
       version=get_package_version(),
@@ -34,6 +36,9 @@ setup(name='vacuum',
       license='MIT',
       packages=find_packages(),
       install_requires=install_requires,
+      extras_require={
+        'zstd': ['zstandard'], # tar.zst archive bundles
+      },
       entry_points={
         'console_scripts': [
             'vacuum = vacuum.__main__:main',
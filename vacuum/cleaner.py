@@ -1,11 +1,121 @@
 # execute cleanup operations 
 import os
+import sys
+import six
 import shutil
+import threading
 
 import logging
 import datetime
 
-from .utils import archive, delete, flister
+from os.path import lexists
+from six.moves import queue
+
+from .utils import archive, delete, iscan_rules, ScanRule
+from .utils import free_space_plan, quota_plan, PlanReport
+from .index import ScanIndex
+from .journal import RunJournal
+
+_DONE = object()
+
+class RuleFeed(object):
+    """
+    Bounded hand-over of the entries planned for a rule to its operation,
+    which consumes them in its own thread while the shared traversal goes on.
+
+    Entries fed with `track` are done once the operation reports them (see
+    `claim`), or else as soon as the next entry is asked for.
+
+    Feeds of an operation share `stop`, set when a rule fails (or, with
+    `raise_errors`, as soon as one of its files does): no more entries are
+    handed over then.
+    """
+    def __init__(self, stop, raise_errors=False, maxsize=1000):
+        self.queue = queue.Queue(maxsize)
+        self.stop = stop
+        self.raise_errors = raise_errors
+        self.thread = None
+        self.error = None
+        self.finished = False
+        self.waiting = {}
+        self.claimed = set()
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        while not self.stop.is_set():
+            item = self.queue.get()
+            if item is _DONE:
+                self.finished = True
+                return
+            entry, done = item
+            if done is not None:
+                with self.lock:
+                    self.waiting[entry.path] = done
+            try:
+                yield entry
+            finally:
+                # dropped by the plan (or no operation): done with it
+                if done is not None and entry.path not in self.claimed:
+                    self.release(entry.path)
+
+    def claim(self, filelist):
+        """
+        Paths of `filelist` handed to an operation running several files at
+        once, which reports each one with `release` when done with it.
+        """
+        for path in filelist:
+            with self.lock:
+                if path in self.waiting:
+                    self.claimed.add(path)
+            yield path
+
+    def release(self, path, error=None):
+        if error is not None and self.raise_errors:
+            self.stop.set()
+        with self.lock:
+            self.claimed.discard(path)
+            done = self.waiting.pop(path, None)
+        if done is not None:
+            done.set()
+
+    def start(self, target, *args):
+        def run():
+            try:
+                target(self, *args)
+            except Exception:
+                self.error = sys.exc_info()
+                self.stop.set()
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed(self, entry, track=False):
+        """
+        Hand `entry` over, with `track` returns an event set once it is done
+        (see `wait`).
+        """
+        done = threading.Event() if track else None
+        if not self._put((entry, done)) and track:
+            done.set()
+        return done
+
+    def wait(self, done):
+        while not done.wait(0.1) and self.thread.is_alive() and \
+              not self.stop.is_set():
+            pass
+
+    def close(self):
+        self._put(_DONE)
+        self.thread.join()
 
 class VacuumCleaner(object):
     """Wrapper to perform cleaning/archive operations"""
@@ -14,6 +124,9 @@ class VacuumCleaner(object):
                  delete_empty=True,
                  relative_to='cycle',
                  stop_on_error=False,
+                 scan_workers=1,
+                 workers=1,
+                 plan_output=None,
                  logger=logging, **kwargs):
         super(VacuumCleaner, self).__init__()
         self.clean = clean
@@ -22,6 +135,10 @@ class VacuumCleaner(object):
         self.delete_empty = delete_empty
         self.relative_to = relative_to
         self.stop_on_error = stop_on_error
+        self.scan_workers = scan_workers
+        self.workers = workers
+        self.plan_output = plan_output
+        self._plan_file = None
         self.logger = logger
         self.set_cycle()
 
@@ -45,39 +162,153 @@ class VacuumCleaner(object):
         else:
             raise Exception('Archive and Cleaning rules must a dict or list of rules')
 
+    def _process_rule(self, feed, operation, rule_id, options, scan_rule):
+        entries = feed
+        self.logger.info('Processing "%s" for "%s"...'% (operation.__name__, 
+                                                      rule_id))
+        if options.get('max_total_size') is not None:
+            entries = quota_plan(entries, options['max_total_size'],
+                                 dates=scan_rule.dates, logger=self.logger)
+        if options.get('target_free') is not None or \
+           options.get('target_free_bytes') is not None:
+            entries = free_space_plan(entries, scan_rule.rootdir,
+                                      options.get('target_free'),
+                                      options.get('target_free_bytes'),
+                                      dates=scan_rule.dates, logger=self.logger)
+        if self.dry_run:
+            # streamed, the plan can be far too big to be held in memory
+            report = PlanReport(rule_id, operation.__name__, self._plan_file,
+                                logger=self.logger)
+            # rules run at once, lines are told apart by rule
+            self.logger.info('Below files of %s would be %sd:' % (rule_id,
+                                                                 operation.__name__))
+            for entry in report(entries):
+                self.logger.info('%s: %s' % (rule_id, entry.path))
+            self.logger.info('%s of %s: %s would be %sd' %\
+                (operation.__name__.title(), rule_id, report, operation.__name__))
+        else:
+            filelist = (entry.path for entry in entries)
+            journal = None
+            if options.get('journal'):
+                journal = RunJournal(options['journal'], logger=self.logger)
+                journal.recover()
+                filelist = journal.skip_done(filelist)
+            try:
+                result = operation(feed.claim(filelist),
+                                   **dict(options, journal=journal, on_done=feed.release))
+            finally:
+                if journal is not None:
+                    journal.close()
+            if journal is not None and feed.finished and not feed.stop.is_set():
+                # a complete run starts the next one afresh
+                journal.complete()
+                self.logger.info('%d file(s) already done by the interrupted run' %\
+                                                                journal.skipped)
+            elif journal is not None:
+                self.logger.warning('Run of %s stopped, journal kept to resume it: %s' %\
+                                                        (rule_id, journal.path))
+            self.logger.info('%s of %s complete: %d files (%d bytes) and %d directories %sd' %\
+                (operation.__name__.title(), rule_id, result.files, result.bytes,
+                 result.directories, operation.__name__))
+            if result.skipped:
+                self.logger.info('%s of %s: %d files already done, skipped' %\
+                    (operation.__name__.title(), rule_id, result.skipped))
+            if result.errors:
+                self.logger.warning('Could not %s some files (%d), please check below...' % \
+                                                            (operation.__name__, result.errors)\
+                                                            +os.linesep+'%s'%\
+                        result.format_errors())
+
     def _archive_or_clean(self, operation, rules, include_hidden):
-        rules = self._prepare_rules(rules)
-        self.logger.info('Processing all "%s" operations...' % operation)
+        """
+        Plan all rules of an operation over a single traversal of their
+        trees, each accepted file is handed to the rule(s) accepting it.
+        Rules with an `index` are planned from their own scan index instead.
+        A rule failing (see `RuleFeed`) stops the traversal and the others.
+        """
+        rules = list(self._prepare_rules(rules))
+        self.logger.info('Processing all "%s" operations...' % operation.__name__)
+        scan_rules, feeds = [], []
+        stop = threading.Event()
         for rule_id, options in rules:
             options['delete_empty'] = options.get('delete_empty', self.delete_empty)
             options['raise_errors'] = options.get('raise_errors', self.stop_on_error)
             options['include_hidden'] = options.get('include_hidden', include_hidden)
-            self.logger.info('Processing "%s" for "%s"...'% (operation.__name__, 
-                                                          rule_id))
-            filelist = flister(now=self.now, **options)
-            if self.dry_run:
-                self.logger.info('Below files would be %sed: %s%s' %\
-                             (operation, os.linesep, os.linesep.join(filelist)))
-                
-            else:
-                success_files, success_dirs, errors = operation(filelist, **options)
-                self.logger.info('%s of %s complete: %d files and %d directories %sd' %\
-                    (operation.__name__.title(),rule_id,len(success_files),len(success_dirs),operation.__name__))
-                if errors:
-                    self.logger.warning('Could not %s some files, please check below...' % \
-                                                                operation.__name__\
-                                                                +os.linesep+'%s'%\
-                            os.linesep.join(['%s: %s' % i for i in errors.items()]))
+            options['workers'] = options.get('workers', self.workers)
+            scan_rules.append(ScanRule(now=self.now, **options))
+        try:
+            for (rule_id, options), scan_rule in zip(rules, scan_rules):
+                feed = RuleFeed(stop, options['raise_errors'])
+                feed.start(self._process_rule, operation, rule_id, options,
+                           scan_rule)
+                feeds.append(feed)
+            shared = [i for i, (_, options) in enumerate(rules)
+                                            if not options.get('index')]
+            # rules taking files away from the rules after them
+            removes = [not self.dry_run and (operation is delete or
+                                             options.get('action') == 'move')
+                       for _, options in rules]
+            for entry, indexes in iscan_rules([scan_rules[i] for i in shared],
+                                              self.scan_workers):
+                if stop.is_set():
+                    break
+                if len(indexes) == 1:
+                    feeds[shared[indexes[0]]].feed(entry)
+                    continue
+                # Overlapping rules get the file in order, the same as running
+                # rules one by one: a rule removing it waits for the rules
+                # before it and the rules after it wait for it. Rules only
+                # reading it (copies, dry runs) get it at once
+                rules_removing = [removes[shared[index]] for index in indexes]
+                handed = []
+                for position, index in enumerate(indexes):
+                    if rules_removing[position] or \
+                       any(rules_removing[i] for i, _ in handed):
+                        for i, done in handed:
+                            feeds[shared[indexes[i]]].wait(done)
+                        handed = []
+                        if not lexists(entry.path):
+                            break
+                    track = any(rules_removing[position:]) and \
+                            position < len(indexes)-1
+                    done = feeds[shared[index]].feed(entry, track)
+                    if track:
+                        handed.append((position, done))
+            for i, (rule_id, options) in enumerate(rules):
+                if options.get('index') and not stop.is_set():
+                    scan_index = ScanIndex(options['index'], logger=self.logger)
+                    try:
+                        for entry in scan_index.iscan(scan_rules[i]):
+                            if stop.is_set():
+                                break
+                            feeds[i].feed(entry)
+                    finally:
+                        scan_index.close()
+        finally:
+            for feed in feeds:
+                feed.close()
+        for feed in feeds:
+            if feed.error:
+                six.reraise(*feed.error)
 
     def run(self):
         self.logger.info('Powering vacuum cleaner...')
         self.logger.info('Older-than will be relative to (%s) %s' %\
                                                  (self.relative_to, self.now))
-        if self.archive:
-            # Default for archive operations is to not include hidden files,
-            # but it can be set in operation rule
-            self._archive_or_clean(archive, self.archive, include_hidden=False)
+        # dry-run plan as JSON lines, to a file or stdout ('-')
+        self._plan_file = None
+        if self.dry_run and self.plan_output:
+            self._plan_file = sys.stdout if self.plan_output == '-' \
+                                         else open(self.plan_output, 'w')
+        try:
+            if self.archive:
+                # Default for archive operations is to not include hidden files,
+                # but it can be set in operation rule
+                self._archive_or_clean(archive, self.archive, include_hidden=False)
 
-        if self.clean:
-            self._archive_or_clean(delete, self.clean, include_hidden=True)
+            if self.clean:
+                self._archive_or_clean(delete, self.clean, include_hidden=True)
+        finally:
+            if self._plan_file not in [None, sys.stdout]:
+                self._plan_file.close()
         
@@ -3,9 +3,10 @@ import sys
 import argparse
 import pprint 
 import six
+import itertools
 import logging
 
-from .utils import flister, delete, archive, setup_logger
+from .utils import flister, iscan, delete, archive, setup_logger, PathEntry, PlanReport
 from .scrub import WhaleScrubber
 
 parser = argparse.ArgumentParser()
@@ -47,8 +48,17 @@ for sub in [parser_list, parser_clean, parser_archive]:
                         action='store',
                         default=None,
                         type=str)
+    sub.add_argument('-w','--workers', 
+                        help='Number of threads listing directories (and deleting or archiving files) in parallel',
+                        action='store',
+                        default=1,
+                        type=int)
     sub.add_argument('root', help='Root directory to search files for')
 
+parser_list.add_argument('--json', 
+                         help='Print files as JSON lines, with their size',
+                         action='store_true')
+
 parser_clean.add_argument('-e','--empty', 
                           help='Delete empty folders as well',
                           action='store_true')
@@ -66,22 +76,29 @@ parser_archive.add_argument('destination',
                             help='Destination directory to archive [copy] files at')
 
 def _list_files(args=None, filelist=None):
-    filelist = filelist or flister(args.root, args.pattern, args.older_than, 
-                                   args.recursive, args.max_depth,
-                                   date_strptime=args.date_strptime, 
-                                   time_strptime=args.time_strptime)
-    files = []
-    for filepath in filelist:
-        print(filepath)
-        files.append(filepath)
-    return files
+    if filelist is None:
+        entries = iscan(args.root, args.pattern, args.older_than, 
+                        args.recursive, args.max_depth,
+                        date_strptime=args.date_strptime, 
+                        time_strptime=args.time_strptime,
+                        workers=args.workers)
+    else:
+        entries = (PathEntry(filepath) for filepath in filelist)
+    # streamed, only the count and size are kept
+    report = PlanReport(output=sys.stdout if getattr(args, 'json', False) else None)
+    for entry in report(entries):
+        if report.output is None:
+            print(entry.path)
+    sys.stderr.write('%s%s' % (report, os.linesep))
+    return report.count
 
 def clean_or_archive(operation, args, **opargs):
     logger = setup_logger()
     filelist = flister(args.root, args.pattern, args.older_than, args.recursive, 
                        args.max_depth, 
                        date_strptime=args.date_strptime, 
-                       time_strptime=args.time_strptime)
+                       time_strptime=args.time_strptime,
+                       workers=args.workers)
     try: 
         first_file = next(filelist)
     except StopIteration: 
@@ -98,19 +115,18 @@ def clean_or_archive(operation, args, **opargs):
             _list_files(filelist=[first_file])
             _list_files(filelist=filelist)
         elif option in ['y','Y']:
-            files0, dirs0, errors0 = operation([first_file], logger=logger, **opargs)
-            files, dirs, errors = operation(filelist, logger=logger, **opargs)
-            errors.update(errors0)
-            if files:
-                logger.info('Successfully vacuum-cleaned %d files and %d directories!' %\
-                                                 (len(files+files0),
-                                                  len(dirs+dirs0)))
-            if errors:
-                message = 'Oh no! Some dust still glued to the floor (%d)! Show? (y/N):' % len(errors)
+            result = operation(itertools.chain([first_file], filelist), 
+                               logger=logger, **opargs)
+            if result.files:
+                logger.info('Successfully vacuum-cleaned %d files (%d bytes) and %d directories!' %\
+                                                 (result.files, result.bytes,
+                                                  result.directories))
+            if result.errors:
+                message = 'Oh no! Some dust still glued to the floor (%d)! Show? (y/N):' % result.errors
                 option = six.moves.input(message) if not args.force else option
                 if option in ['y','Y']:
                     logger.error('%s: %s%s' % (message, os.linesep, 
-                                 os.linesep.join(['%s: %s' % (k,v) for k,v in errors.items()])))
+                                 result.format_errors()))
             break
         elif option in ['n','N']:
             break
@@ -124,6 +140,8 @@ parser_scrub.add_argument('--filter', help="Add filter values for image/containe
                           action='append')
 parser_scrub.add_argument('-f','--force', help="Force removal of images or containers",
                           action='store_true')
+parser_scrub.add_argument('-w','--workers', help="Number of images or containers removed in parallel",
+                          action='store', default=1, type=int)
 
 def _scrub(args):
     logger = setup_logger()
@@ -132,7 +150,7 @@ def _scrub(args):
             'filters': [dict(v.split('=') for v in args.filter)] if args.filter else {},
             'force' : args.force,
         }
-    scrubber = WhaleScrubber(logger=logger)
+    scrubber = WhaleScrubber(logger=logger, workers=args.workers)
     if args.target == 'images':
         scrubber.images = config
     elif args.target == 'containers':
@@ -140,12 +158,15 @@ def _scrub(args):
     scrubber.run()
 
 def _clean(args):
-    clean_or_archive(delete, args, delete_empty=args.empty)
+    clean_or_archive(delete, args, delete_empty=args.empty, workers=args.workers,
+                                   rootdir=args.root)
 
 def _archive(args):
     clean_or_archive(archive, args, root_depth=args.root_depth, 
                                     destination=args.destination,
-                                    action=args.action)
+                                    action=args.action,
+                                    workers=args.workers,
+                                    rootdir=args.root)
 
 parser_list.set_defaults(func=_list_files)
 parser_clean.set_defaults(func=_clean)
@@ -0,0 +1,174 @@
+# Persistent scan index for incremental re-scans
+import os
+import sqlite3
+import logging
+
+from os.path import join, lexists
+
+from .utils import scandir, timestamp, PathEntry, _expand_rootdir
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    depth INTEGER NOT NULL,
+    seen INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    age REAL,
+    size INTEGER,
+    PRIMARY KEY (dir, name)
+);
+CREATE INDEX IF NOT EXISTS entries_age ON entries (kind, age);
+"""
+
+class ScanIndex(object):
+    """
+    On-disk (sqlite) index of the tree of a rule: the mtime of directories
+    and the kind, size and age (date in path or mtime) of their entries.
+
+    A refresh only re-lists directories whose mtime changed since the last
+    run (a single stat for the others) and expiry candidates come from a
+    query on ages. As changing a file doesn't change its directory mtime,
+    candidates are stat-ed again before being generated.
+    """
+    def __init__(self, path, logger=logging):
+        self.path = path
+        self.logger = logger
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _kind(self, entry):
+        if entry.is_symlink():
+            return 'dirlink' if entry.is_dir() else 'link'
+        elif entry.is_file():
+            return 'file'
+        elif entry.is_dir():
+            return 'dir'
+        return 'other'
+
+    def _age(self, rule, path, stat):
+        dt = rule.dates(path) if rule.dates else None
+        return timestamp(dt) if dt else stat.st_mtime
+
+    def _list(self, rule, dirpath, mtime, depth, run):
+        rows = []
+        for entry in scandir(dirpath):
+            kind = self._kind(entry)
+            age, size = None, None
+            if kind == 'file':
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                age, size = self._age(rule, entry.path, stat), stat.st_size
+            rows.append((dirpath, entry.name, kind, age, size))
+        self.db.execute('DELETE FROM entries WHERE dir = ?', (dirpath,))
+        self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+        self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                        (dirpath, mtime, depth, run))
+        return [(name, kind) for _, name, kind, _, _ in rows
+                                        if kind in ['dir', 'dirlink']]
+
+    def refresh(self, rule):
+        """
+        Bring the index up to date with the tree of `rule`, returns the
+        number of directories listed and of unchanged ones.
+        """
+        run = (self.db.execute('SELECT MAX(seen) FROM dirs').fetchone()[0] or 0)+1
+        listed = unchanged = 0
+        todo = [(dirpath, 1) for dirpath in _expand_rootdir(rule.rootdir)]
+        with self.db:
+            while todo:
+                dirpath, depth = todo.pop()
+                try:
+                    mtime = os.stat(dirpath).st_mtime
+                except OSError:
+                    continue
+                row = self.db.execute('SELECT mtime FROM dirs WHERE path = ?',
+                                      (dirpath,)).fetchone()
+                if row and row[0] == mtime:
+                    self.db.execute('UPDATE dirs SET seen = ?, depth = ? WHERE path = ?',
+                                    (run, depth, dirpath))
+                    subdirs = self.db.execute("SELECT name, kind FROM entries WHERE "
+                                              "dir = ? AND kind IN ('dir', 'dirlink')",
+                                              (dirpath,)).fetchall()
+                    unchanged += 1
+                else:
+                    try:
+                        subdirs = self._list(rule, dirpath, mtime, depth, run)
+                    except OSError:
+                        continue
+                    listed += 1
+                if not rule.descends(depth):
+                    continue
+                for name, kind in subdirs:
+                    if name.startswith('.') and not rule.include_hidden:
+                        continue
+                    # links to directories matching patterns are taken as links
+                    if kind == 'dirlink' and rule.matcher.match(name):
+                        continue
+                    todo.append((join(dirpath, name), depth+1))
+            # forget directories gone or out of the rule scope
+            self.db.execute('DELETE FROM entries WHERE dir IN '
+                            '(SELECT path FROM dirs WHERE seen != ?)', (run,))
+            self.db.execute('DELETE FROM dirs WHERE seen != ?', (run,))
+        return listed, unchanged
+
+    def _candidates(self, rule):
+        if rule.than is None:
+            query = "SELECT dir, name, kind FROM entries WHERE kind != 'dir'"
+            args = ()
+        else:
+            query = "SELECT dir, name, kind FROM entries WHERE " \
+                    "(kind = 'file' AND age < ?) OR kind IN ('link', 'dirlink')"
+            args = (timestamp(rule.than),)
+        # streamed from its own cursor, the index can be far too big for memory
+        cursor = self.db.cursor()
+        for dirpath, name, kind in cursor.execute(query, args):
+            if kind == 'other':
+                continue
+            if name.startswith('.') and not rule.include_hidden:
+                continue
+            if rule.matcher.match(name):
+                yield join(dirpath, name), name, kind
+
+    def iscan(self, rule):
+        """
+        Refresh the index and generate a `PathEntry` for each file `rule`
+        accepts, same as `iscan` would.
+        """
+        listed, unchanged = self.refresh(rule)
+        self.logger.info('Index %s: %d directories listed, %d unchanged' %\
+                                            (self.path, listed, unchanged))
+        stale = []
+        for path, name, kind in self._candidates(rule):
+            try:
+                if kind == 'file':
+                    stat = os.stat(path)
+                    age = self._age(rule, path, stat)
+                    if rule.than is not None and age >= timestamp(rule.than):
+                        # modified in place since indexed
+                        stale.append((age, stat.st_size, path))
+                        continue
+                else:
+                    stat = os.lstat(path)
+            except OSError:
+                continue
+            yield PathEntry(path, stat)
+        # empty dirs are yielded as well regardless of parameters
+        empty = self.db.execute('SELECT path FROM dirs WHERE depth > 1 AND NOT EXISTS '
+                                '(SELECT 1 FROM entries WHERE dir = dirs.path)').fetchall()
+        for dirpath, in empty:
+            if lexists(dirpath) and not os.listdir(dirpath):
+                yield PathEntry(dirpath, os.stat(dirpath))
+        with self.db:
+            for age, size, path in stale:
+                self.db.execute('UPDATE entries SET age = ?, size = ? WHERE dir = ? '
+                                'AND name = ?', (age, size) + os.path.split(path))
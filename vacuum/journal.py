@@ -0,0 +1,94 @@
+# Resumable run journal
+import os
+import json
+import errno
+import logging
+import threading
+
+class RunJournal(object):
+    """
+    Append-only journal of the run of a rule: temporary files in flight
+    (``T`` lines) and files done (``D`` lines). Each line is written through
+    to the OS but only fsync-ed every `sync_every` lines.
+
+    A run interrupted is resumed from its journal: files done are skipped and
+    temporary files left behind removed. Completing the run removes it.
+    """
+    def __init__(self, path, logger=logging, sync_every=1000):
+        self.path = path
+        self.logger = logger
+        self.sync_every = sync_every
+        self.lock = threading.Lock()
+        self.done = set()
+        self.skipped = 0
+        self.unsynced = 0
+        self.file = None
+
+    def recover(self):
+        """
+        Load the journal of an interrupted run and remove its temporary files,
+        returns the number of files done and of temporary files removed.
+        """
+        temps = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        kind, path = line[0], json.loads(line[2:])
+                    except ValueError:
+                        # torn last line
+                        continue
+                    if kind == 'D':
+                        self.done.add(path)
+                    elif kind == 'T':
+                        temps.add(path)
+        removed = 0
+        for tmp_file in temps:
+            try:
+                os.remove(tmp_file)
+                removed += 1
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    self.logger.warning('Could not remove temporary file %s: %s' %\
+                                                                (tmp_file, exc))
+        if self.done or removed:
+            self.logger.info('Resuming from %s: %d file(s) already done, %d '
+                             'temporary file(s) removed' % (self.path,
+                                                            len(self.done), removed))
+        self.file = open(self.path, 'a')
+        return len(self.done), removed
+
+    def _write(self, kind, path):
+        with self.lock:
+            self.file.write('%s %s\n' % (kind, json.dumps(path)))
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def temp(self, path):
+        self._write('T', path)
+
+    def commit(self, path):
+        self._write('D', path)
+
+    def skip_done(self, filelist):
+        for filepath in filelist:
+            if filepath in self.done:
+                self.skipped += 1
+                continue
+            yield filepath
+
+    def close(self):
+        if self.file is not None and not self.file.closed:
+            with self.lock:
+                self._sync()
+                self.file.close()
+
+    def complete(self):
+        self.close()
+        os.remove(self.path)
@@ -2,10 +2,49 @@
 import docker
 import logging
 import six
-import re
+import heapq
+import calendar
 import datetime
+import collections
 
-from .utils import pastdt
+from .utils import pastdt, parse_size, PatternMatcher, _imap_bounded
+
+# filters of rules the daemon prune endpoints can apply themselves
+PRUNE_FILTERS = set(['older_than', 'until', 'label'])
+
+# image of a `df` listing, as much of an Image as removals need
+DfImage = collections.namedtuple('DfImage', ['id', 'tags'])
+
+class IgnoreMatcher(object):
+    """
+    Ignore patterns of a scrub rule compiled once into a `PatternMatcher`,
+    with results cached per name (up to `cache_size` names).
+    """
+    def __init__(self, ignores, cache_size=100000):
+        self.matcher = PatternMatcher(ignores) if ignores else None
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.matcher.compiled) if self.matcher else 0
+
+    def _match(self, name):
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        matched = self.cache[name] = self.matcher.match(name)
+        return matched
+
+    def matches(self, names):
+        """ True if any of `names` matches an ignore pattern """
+        if self.matcher is None:
+            return False
+        if not isinstance(names, (list,tuple)):
+            names = [names]
+        return any(self._match(name) for name in names)
 
 class WhaleScrubber(object):
     """
@@ -13,9 +52,12 @@ class WhaleScrubber(object):
     """
     def __init__(self, images={}, containers={}, client=None, 
                  relative_to='cycle',
+                 workers=1,
                  logger=logging, **kwargs):
         super(WhaleScrubber, self).__init__()
         self.client = client or docker.from_env()
+        self.workers = workers
+        self.space_reclaimed = 0
         self.logger = logger
         self.images = images
         self.containers = containers
@@ -40,15 +82,9 @@ class WhaleScrubber(object):
         return list(ignores)
 
     def _not_matches_ignores(self, ignores, names):
-        if not isinstance(names, (list,tuple)):
-            names = [names]
-        not_matches = True
-        for ignore in ignores:
-            reignore = re.compile(ignore)
-            for name in names:
-                if reignore.match(name):
-                    return False
-        return not_matches
+        if not isinstance(ignores, IgnoreMatcher):
+            ignores = IgnoreMatcher(ignores)
+        return not ignores.matches(names)
 
     def _maybe_remove_image(self, image, force, ignores=[]):
         tag = ','.join(image.tags) or image.id
@@ -57,6 +93,11 @@ class WhaleScrubber(object):
                 self.logger.debug('Scrubbing image (%s)...' % tag)
                 self.client.images.remove(image.id, force=force)
                 self.logger.info('Ahoy! Image scrubbed: (%s)' % tag)
+                return True
+        except docker.errors.NotFound:
+            # untagged parents go along with their last child
+            self.logger.debug('Image already scrubbed (%s)' % tag)
+            return True
         except docker.errors.APIError as exc:
             self.logger.warning('Arrgh! Sticky image (%s): %s' %\
                                              (tag,exc.explanation))
@@ -71,6 +112,106 @@ class WhaleScrubber(object):
             self.logger.warning('Arrgh! Sticky container (%s): %s' %\
                                          (container.name, exc.explanation))
 
+    def _remove_all(self, remove, objects, workers=None):
+        """
+        Call `remove` (which logs its own errors) for each object, up to
+        `workers` at once, returns the objects it removed.
+        """
+        workers = workers or self.workers
+        removed = []
+        for obj, done, exc in _imap_bounded(remove, objects, workers):
+            if exc is not None:
+                raise exc
+            if done:
+                removed.append(obj)
+        return removed
+
+    def _image_graph(self, force=False):
+        """
+        Parent of each image and count of children, images used by containers
+        (unless `force`) and untagged (intermediate) images, from a single
+        listing of all images (and of all containers) by the low level API,
+        which does not inspect each of them.
+        """
+        listed = self.client.api.images(all=True)
+        parents = dict((image['Id'], image.get('ParentId')) for image in listed)
+        children = collections.Counter(parent for parent in parents.values() if parent)
+        untagged = set(image['Id'] for image in listed if not
+                       [tag for tag in image.get('RepoTags') or [] if tag != '<none>:<none>'])
+        used = set()
+        if not force:
+            used.update(container.get('ImageID') for container in
+                                    self.client.api.containers(all=True))
+        return parents, children, used, untagged
+
+    def _remove_images(self, images, graph, force, ignores=[], workers=None):
+        """
+        Remove images leaves first, in waves: an image is only attempted once
+        all of its children (and, unless `force`, containers using it) are gone
+        (see `_image_graph`), so parents don't fail on dependent child images.
+        Images of a wave are removed in parallel.
+        """
+        parents, children, used, untagged = graph
+        pending = collections.OrderedDict((image.id, image) for image in images)
+        nwave = 0
+        while True:
+            wave = [image for image in pending.values() 
+                        if not children[image.id] and image.id not in used]
+            if not wave:
+                break
+            nwave += 1
+            self.logger.debug('Scrubbing images wave %d (%d images)...' % (nwave, len(wave)))
+            for image in wave:
+                del pending[image.id]
+            remove = lambda image: self._maybe_remove_image(image, force, ignores)
+            for image in self._remove_all(remove, wave, workers):
+                parent = parents.get(image.id)
+                while parent:
+                    children[parent] -= 1
+                    # untagged parents left without children go along with it
+                    if children[parent] or parent not in untagged or \
+                       parent in pending or parent in used:
+                        break
+                    parent = parents.get(parent)
+        if pending:
+            self.logger.info('Kept %d image(s) with dependent child images or '
+                             'containers' % len(pending))
+
+    def _pushdown(self, ifilter, key, value, needs_age=False):
+        """
+        Prune filters for a rule filter selecting `key`: `value` (exited
+        containers or dangling images) and nothing else than an age or labels,
+        None if it must be listed and filtered client side (or, with
+        `needs_age`, if it has no age).
+        """
+        if ifilter.get(key) != value or not set(ifilter)-set([key]) <= PRUNE_FILTERS:
+            return None
+        if needs_age and not (ifilter.get('older_than') or ifilter.get('until')):
+            return None
+        filters = dict((k, v) for k, v in ifilter.items() if k in ['until', 'label'])
+        if ifilter.get('older_than'):
+            than = pastdt(ifilter['older_than'], utc=True)
+            filters['until'] = str(calendar.timegm(than.timetuple()))
+        return filters
+
+    def _prune(self, collection, kind, filters):
+        """
+        Single prune call for `kind` (Images or Containers), logs the space
+        the daemon reclaimed
+        """
+        self.logger.info('Pruning %s (%s)...' % (kind.lower(), filters))
+        try:
+            result = collection.prune(filters=filters)
+        except docker.errors.APIError as exc:
+            self.logger.warning('Arrgh! Could not prune %s: %s' %\
+                                        (kind.lower(), exc.explanation))
+            return
+        deleted = result.get('%sDeleted' % kind) or []
+        reclaimed = result.get('SpaceReclaimed') or 0
+        self.space_reclaimed += reclaimed
+        self.logger.info('Ahoy! %d %s pruned, %d bytes reclaimed' %\
+                                        (len(deleted), kind.lower(), reclaimed))
+
     def _created_before_than(self, containers, older_than):
         older_containers = []
         than = pastdt(older_than, utc=True)
@@ -82,13 +223,75 @@ class WhaleScrubber(object):
                 older_containers.append(container)
         return older_containers
 
-    def _clean_images(self, ignore=[], filters=[], force=False):
-        ignores = self._listify_ignore(ignore)
+    def _scrub_to_budget(self, budget, ignores, force=False, workers=None):
+        """
+        Remove unused images, least recently created first, until the space
+        used by images is within `budget`. Sizes, creation times, parents and
+        containers come from a single `df`; images enter a heap once they have
+        no children left and are popped only while over budget.
+        """
+        budget = parse_size(budget)
+        workers = workers or self.workers
+        df = self.client.df()
+        usage = df.get('LayersSize') or 0
+        if usage <= budget:
+            self.logger.info('Images use %d bytes, within budget (%d bytes)' % (usage, budget))
+            return
+        images = dict((info['Id'], info) for info in df.get('Images') or [])
+        children = collections.Counter(info.get('ParentId') for info in images.values())
+        def unused(info):
+            return not children[info['Id']] and info.get('Containers', 0) <= 0 and \
+                   not ignores.matches(info.get('RepoTags') or [])
+        def freed(info):
+            # layers shared with other images are not freed
+            return info.get('Size', 0)-max(info.get('SharedSize', 0), 0)
+        heap = [(info.get('Created', 0), image_id) for image_id, info in images.items()
+                                                                if unused(info)]
+        heapq.heapify(heap)
+        self.logger.info('Scrubbing images from %d bytes down to %d bytes...' % (usage, budget))
+        remove = lambda image: self._maybe_remove_image(image, force, ignores)
+        while heap and usage > budget:
+            batch, planned = [], 0
+            while heap and len(batch) < workers and usage-planned > budget:
+                info = images[heapq.heappop(heap)[1]]
+                planned += freed(info)
+                batch.append(DfImage(info['Id'], info.get('RepoTags') or []))
+            for image in self._remove_all(remove, batch, workers):
+                usage -= freed(images[image.id])
+                parent = images.get(images[image.id].get('ParentId'))
+                if parent is not None:
+                    children[parent['Id']] -= 1
+                    if unused(parent):
+                        heapq.heappush(heap, (parent.get('Created', 0), parent['Id']))
+        if usage > budget:
+            self.logger.warning('Arrgh! Images still use about %d bytes, over budget '
+                                '(%d bytes)' % (usage, budget))
+        else:
+            self.logger.info('Ahoy! Images now use about %d bytes' % usage)
+
+    def _clean_images(self, ignore=[], filters=[], force=False, workers=None,
+                      budget=None):
+        ignores = IgnoreMatcher(self._listify_ignore(ignore))
+        if budget is not None:
+            return self._scrub_to_budget(budget, ignores, force, workers)
+        listed = []
+        for ifilter in filters:
+            prune = None
+            if not ignores and not force:
+                prune = self._pushdown(ifilter, 'dangling', True)
+            if prune is None:
+                listed.append(ifilter)
+            else:
+                prune['dangling'] = True
+                self._prune(self.client.images, 'Images', prune)
+        if filters and not listed:
+            return
+        graph = self._image_graph(force)
         images = []
         if not filters:
             images.extend(self.client.images.list())
         else:
-            for ifilter in filters:
+            for ifilter in listed:
                 name = ifilter.pop('name', None)
                 images.extend(self.client.images.list(name=name, filters=ifilter))
 
@@ -97,16 +300,27 @@ class WhaleScrubber(object):
         else:
             self.logger.info('Blimey! No fouling images to scrub for the giving filters.')
 
-        for image in images:
-            self._maybe_remove_image(image, force, ignores)
+        self._remove_images(images, graph, force, ignores, workers)
 
-    def _clean_containers(self, ignore=[], filters=[], force=False):
-        ignores = self._listify_ignore(ignore)
+    def _clean_containers(self, ignore=[], filters=[], force=False, workers=None):
+        ignores = IgnoreMatcher(self._listify_ignore(ignore))
+        listed = []
+        for ifilter in filters:
+            prune = None
+            if not ignores:
+                # prune also takes containers just created, not started yet
+                prune = self._pushdown(ifilter, 'status', 'exited', needs_age=True)
+            if prune is None:
+                listed.append(ifilter)
+            else:
+                self._prune(self.client.containers, 'Containers', prune)
+        if filters and not listed:
+            return
         containers = []
         if not filters:
             containers.extend(self.client.containers.list(all=True))
         else:
-            for ifilter in filters:
+            for ifilter in listed:
                 older_than = ifilter.pop('older_than', None)
                 filtered = self.client.containers.list(all=True, 
                                                           filters=ifilter)
@@ -118,11 +332,15 @@ class WhaleScrubber(object):
         else:
             self.logger.info('Blimey! No fouling containers to scrub for the giving filters.')
 
-        for container in containers:
-            self._maybe_remove_container(container, force, ignores)
+        self._remove_all(lambda container: self._maybe_remove_container(container, 
+                                                                         force, ignores),
+                         containers, workers)
     
     def run(self):
+        # all containers are gone before their images are attempted
         if self.containers:
             self._clean_containers(**self.containers)
         if self.images:
             self._clean_images(**self.images)
+        if self.space_reclaimed:
+            self.logger.info('Space reclaimed by prune: %d bytes' % self.space_reclaimed)
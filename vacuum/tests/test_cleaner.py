@@ -6,12 +6,15 @@ import tempfile
 import shutil
 import pytest
 import time
+import json
+import threading
 from datetime import datetime,timedelta
 from os.path import *
 
 import docker
 
 from ..cleaner import VacuumCleaner
+import vacuum.utils
 from ..utils import pastdt
 
 
@@ -63,6 +66,19 @@ class VacuumCleanerCleanTest(unittest.TestCase):
         self.vacuum.run()
         assert all([exists(f) for f in self.files])
 
+    def test_dry_run_plan_output(self):
+        plan = join(tempfile.mkdtemp(), 'plan.jsonl')
+        self.vacuum.dry_run = True
+        self.vacuum.plan_output = plan
+        self.vacuum.clean = {'tmp': dict(rootdir=self.rootdir)}
+        self.vacuum.run()
+        assert all([exists(f) for f in self.files])
+        with open(plan) as f:
+            lines = [json.loads(line) for line in f]
+        assert sorted(l['path'] for l in lines) == sorted(self.files)
+        assert all(l['rule'] == 'tmp' and l['operation'] == 'delete' for l in lines)
+        shutil.rmtree(dirname(plan))
+
     def test_clean(self):
         self.vacuum.clean = [dict(rootdir=self.rootdir)]
         self.vacuum.run()
@@ -117,6 +133,130 @@ class VacuumCleanerCleanTest(unittest.TestCase):
         with pytest.raises(Exception):
             self.vacuum.run()
 
+    def test_clean_overlapping_rules(self):
+        subdir = tempfile.mkdtemp(dir=self.rootdir)
+        subfiles = create_files(dir=subdir, suffix='.nc')
+        self.vacuum.delete_empty = False
+        self.vacuum.clean = {
+            'all': dict(rootdir=self.rootdir, recursive=True),
+            'nc': dict(rootdir=join(self.rootdir, '*'), patterns=['.+\\.nc']),
+        }
+        self.vacuum.run()
+        assert not any([exists(f) for f in self.files+subfiles])
+        assert exists(subdir)
+
+    def test_clean_dated_dirs(self):
+        now = datetime.utcnow()
+        old = join(self.rootdir, (now-timedelta(days=5)).strftime('%Y%m%d'))
+        recent = join(self.rootdir, (now-timedelta(days=1)).strftime('%Y%m%d'))
+        for dirpath in [old, recent]:
+            os.makedirs(join(dirpath, 'sub'))
+            create_files(dir=join(dirpath, 'sub'))
+        self.vacuum.clean = [dict(rootdir=self.rootdir, recursive=True, 
+                                  older_than='3d', date_strptime='%Y%m%d',
+                                  dated_dirs=True)]
+        self.vacuum.run()
+        assert not exists(old)
+        assert len(os.listdir(join(recent, 'sub'))) == 5
+
+    def test_clean_scan_workers(self):
+        subdir = tempfile.mkdtemp(dir=self.rootdir)
+        subfiles = create_files(dir=subdir)
+        self.vacuum.scan_workers = 4
+        self.vacuum.clean = [dict(rootdir=self.rootdir, recursive=True)]
+        self.vacuum.run()
+        assert not any([exists(f) for f in self.files+subfiles])
+
+    def test_clean_with_index(self):
+        dbpath = join(tempfile.mkdtemp(), 'index.sqlite')
+        self.vacuum.delete_empty = False
+        self.vacuum.clean = [dict(rootdir=self.rootdir, index=dbpath)]
+        self.vacuum.run()
+        assert not any([exists(f) for f in self.files])
+        self.files = create_files(dir=self.rootdir)
+        self.vacuum.run()
+        assert not any([exists(f) for f in self.files])
+        shutil.rmtree(dirname(dbpath))
+
+    def test_clean_target_free(self):
+        for i, filepath in enumerate(self.files):
+            set_mtime(filepath, datetime.now()-timedelta(hours=i+1))
+        def statvfs(path):
+            removed = sum(1 for f in self.files if not exists(f))
+            return mock.Mock(f_frsize=1, f_blocks=1000, f_bavail=100+removed)
+        self.vacuum.delete_empty = False
+        self.vacuum.clean = [dict(rootdir=self.rootdir, target_free_bytes=102)]
+        with mock.patch('os.statvfs', side_effect=statvfs):
+            self.vacuum.run()
+        # empty files are all planned, removal stops once the target is met
+        assert [exists(f) for f in self.files] == [True]*3+[False]*2
+
+    def test_clean_max_total_size(self):
+        for i, filepath in enumerate(self.files):
+            with open(filepath, 'w') as f:
+                f.write('x'*10)
+            set_mtime(filepath, datetime.now()-timedelta(hours=i))
+        self.vacuum.delete_empty = False
+        self.vacuum.clean = [dict(rootdir=self.rootdir, max_total_size=25)]
+        self.vacuum.run()
+        assert [exists(f) for f in self.files] == [True]*2+[False]*3
+
+    def test_clean_dated_dirs_max_total_size(self):
+        now = datetime.utcnow()
+        old = join(self.rootdir, (now-timedelta(days=5)).strftime('%Y%m%d'))
+        os.makedirs(join(old, 'sub'))
+        for i, filepath in enumerate(create_files(dir=join(old, 'sub'))):
+            with open(filepath, 'w') as f:
+                f.write('x'*10)
+            set_mtime(filepath, datetime.now()-timedelta(days=5, hours=i))
+        self.vacuum.clean = [dict(rootdir=self.rootdir, recursive=True, older_than='3d',
+                                  date_strptime='%Y%m%d', dated_dirs=True,
+                                  max_total_size=25)]
+        self.vacuum.run()
+        # files of the expired directory are weighed one by one
+        assert len(os.listdir(join(old, 'sub'))) == 2
+
+    @mock.patch('vacuum.cleaner.delete', side_effect=OSError('Not permitted'))
+    def test_clean_overlapping_rules_with_errors_stop(self, delete):
+        delete.__name__ = 'delete'
+        self.vacuum.clean = [dict(rootdir=self.rootdir), dict(rootdir=self.rootdir)]
+        with pytest.raises(OSError):
+            self.vacuum.run()
+
+    def test_clean_stop_on_error_stops_other_rules(self):
+        dir_a, dir_b = join(self.rootdir, 'a'), join(self.rootdir, 'b')
+        os.mkdir(dir_a)
+        os.mkdir(dir_b)
+        files_a = create_files(dir=dir_a)
+        files_b = create_files(50, dir=dir_b)
+        failed = threading.Event()
+        real_remove = os.remove
+        def remove(path):
+            if dirname(path) == dir_a:
+                failed.set()
+                raise OSError(13, 'Permission denied', path)
+            # not before rule a failed
+            failed.wait(1)
+            time.sleep(0.05)
+            real_remove(path)
+        self.vacuum.stop_on_error = True
+        self.vacuum.delete_empty = False
+        self.vacuum.clean = [dict(rootdir=dir_a), dict(rootdir=dir_b)]
+        with mock.patch('os.remove', side_effect=remove):
+            with pytest.raises(OSError):
+                self.vacuum.run()
+        assert all(exists(f) for f in files_a)
+        assert sum(exists(f) for f in files_b) >= len(files_b)-1
+
+    def test_dry_run_lines_by_rule(self):
+        self.vacuum.dry_run = True
+        self.vacuum.logger = mock.MagicMock()
+        self.vacuum.clean = {'tmp': dict(rootdir=self.rootdir)}
+        self.vacuum.run()
+        lines = [call[0][0] for call in self.vacuum.logger.info.call_args_list]
+        assert sorted(l for l in lines if l.startswith('tmp: ')) == \
+                    sorted('tmp: %s' % f for f in self.files)
+
 class VacuumCleanerArchiveTest(unittest.TestCase):
     def setUp(self):
         self.vacuum = VacuumCleaner()
@@ -224,7 +364,137 @@ class VacuumCleanerArchiveTest(unittest.TestCase):
         basename = os.path.basename(tmpfile)
         assert open(os.path.join(self.destination, basename)).read() == open(tmpfile).read()
 
-    @mock.patch('shutil.copy2', side_effect=OSError('Not permitted'))
+    def test_archive_overlapping_copy_then_move(self):
+        destination2 = tempfile.mkdtemp(dir=self.destination)
+        self.vacuum.delete_empty = False
+        self.vacuum.archive = [
+            {'destination' : destination2, 'rootdir': self.rootdir, 'action': 'copy'},
+            {'destination' : self.destination, 'rootdir': self.rootdir, 'action': 'move'},
+        ]
+        self.vacuum.run()
+        assert not os.listdir(self.rootdir)
+        assert len(os.listdir(destination2)) == len(self.files)
+        assert len(os.listdir(self.destination)) == len(self.files)+1
+
+    def test_archive_overlapping_copy_then_move_workers(self):
+        files = self.files+create_files(195, dir=self.rootdir)
+        destination2 = tempfile.mkdtemp(dir=self.destination)
+        self.vacuum.delete_empty = False
+        self.vacuum.workers = 4
+        self.vacuum.archive = [
+            {'destination' : destination2, 'rootdir': self.rootdir, 'action': 'copy'},
+            {'destination' : self.destination, 'rootdir': self.rootdir, 'action': 'move'},
+        ]
+        self.vacuum.run()
+        assert not os.listdir(self.rootdir)
+        assert len(os.listdir(destination2)) == len(files)
+        assert len(os.listdir(self.destination)) == len(files)+1
+
+    def test_archive_overlapping_move_then_copy(self):
+        destination2 = tempfile.mkdtemp(dir=self.destination)
+        self.vacuum.delete_empty = False
+        self.vacuum.workers = 4
+        self.vacuum.archive = [
+            {'destination' : destination2, 'rootdir': self.rootdir, 'action': 'move'},
+            {'destination' : self.destination, 'rootdir': self.rootdir, 'action': 'copy'},
+        ]
+        self.vacuum.run()
+        # moved by the first rule, nothing left for the second one
+        assert len(os.listdir(destination2)) == len(self.files)
+        assert os.listdir(self.destination) == [basename(destination2)]
+
+    def test_archive_overlapping_copies_run_at_once(self):
+        files = self.files+create_files(15, dir=self.rootdir)
+        destination2 = tempfile.mkdtemp(dir=self.destination)
+        self.vacuum.workers = 4
+        self.vacuum.archive = [
+            {'destination' : destination2, 'rootdir': self.rootdir, 'action': 'copy'},
+            {'destination' : self.destination, 'rootdir': self.rootdir, 'action': 'copy'},
+        ]
+        running, most = set(), []
+        lock = threading.Lock()
+        real_copy = vacuum.utils.copy_file
+        def copy_file(src, dst):
+            with lock:
+                running.add(dst)
+                most.append(len(running))
+            time.sleep(0.02)
+            real_copy(src, dst)
+            with lock:
+                running.discard(dst)
+        with mock.patch('vacuum.utils.copy_file', side_effect=copy_file):
+            self.vacuum.run()
+        assert len(os.listdir(destination2)) == len(files)
+        assert len(os.listdir(self.destination)) == len(files)+1
+        # copies of a file don't wait for each other, nor for the other files
+        assert max(most) > 2
+
+    def test_archive_bundle(self):
+        self.vacuum.archive = [{'destination' : self.destination, 'rootdir': self.rootdir,
+                                'action': 'move', 'format': 'zip', 'bundle_name': 'tmp'}]
+        self.vacuum.run()
+        assert not any([exists(f) for f in self.files])
+        assert sorted(os.listdir(self.destination)) == ['tmp.zip', 'tmp.zip.index']
+
+    def test_archive_resumes_from_journal(self):
+        journal = join(tempfile.mkdtemp(), 'archive.journal')
+        tmp_file = join(self.destination, basename(self.files[1])+'.abcdefgh')
+        open(tmp_file, 'w').close()
+        with open(journal, 'w') as f:
+            f.write('D %s\n' % json.dumps(self.files[0]))
+            f.write('T %s\n' % json.dumps(tmp_file))
+        self.vacuum.archive = [{'destination' : self.destination,
+                                'rootdir': self.rootdir, 'action': 'copy',
+                                'journal': journal}]
+        self.vacuum.run()
+        # already done by the previous run, not copied again
+        assert sorted(os.listdir(self.destination)) ==\
+                        sorted(basename(f) for f in self.files[1:])
+        assert not exists(journal)
+        shutil.rmtree(dirname(journal))
+
+    def test_archive_dedup_rules_share_store(self):
+        # each file goes to both rules, one after the other
+        self.vacuum.archive = [
+            {'destination': self.destination, 'rootdir': self.rootdir, 'action': 'copy',
+             'dedup': True},
+            {'destination': self.destination, 'rootdir': self.rootdir, 'action': 'copy',
+             'dedup': True, 'patterns': ['tmp.+']}]
+        self.vacuum.run()
+        store = join(self.destination, '.vacuum-store')
+        objects = [name for subdir in os.listdir(store) if isdir(join(store, subdir))
+                   for name in os.listdir(join(store, subdir))]
+        assert len(objects) == 1
+
+    def test_archive_stopped_keeps_journal(self):
+        journal = join(tempfile.mkdtemp(), 'archive.journal')
+        dir_a, dir_b = join(self.rootdir, 'a'), join(self.rootdir, 'b')
+        os.mkdir(dir_a)
+        os.mkdir(dir_b)
+        create_files(dir=dir_a)
+        create_files(50, dir=dir_b)
+        failed = threading.Event()
+        real_copy = vacuum.utils.copy_file
+        def copy_file(src, dst):
+            if dirname(src) == dir_a:
+                failed.set()
+                raise OSError(13, 'Permission denied', src)
+            failed.wait(1)
+            time.sleep(0.05)
+            real_copy(src, dst)
+        self.vacuum.stop_on_error = True
+        self.vacuum.archive = [
+            {'destination': self.destination, 'rootdir': dir_a, 'action': 'copy'},
+            {'destination': self.destination, 'rootdir': dir_b, 'action': 'copy',
+             'journal': journal}]
+        with mock.patch('vacuum.utils.copy_file', side_effect=copy_file):
+            with pytest.raises(Exception):
+                self.vacuum.run()
+        # rule b was stopped, its next run resumes
+        assert exists(journal)
+        shutil.rmtree(dirname(journal))
+
+    @mock.patch('vacuum.utils.copy_file', side_effect=OSError('Not permitted'))
     def test_archive_with_errors(self, move):
         self.vacuum.archive = [{
             'destination' : self.destination,
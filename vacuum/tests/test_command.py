@@ -5,6 +5,7 @@ import tempfile
 import shutil
 import datetime
 import pytest
+import json
 import unittest
 
 from ..command import parser
@@ -16,11 +17,10 @@ def test_list_command_with_pattern():
     files = args.func(args)
     assert files
 
-@mock.patch('vacuum.utils.getmtime')
-def test_list_older_than(getmtime):
-    getmtime.return_value = timestamp(datetime.datetime.now()\
-                            - datetime.timedelta(days=11))
+def test_list_older_than():
     with tempfile.NamedTemporaryFile() as tmpfile:
+        mtime = timestamp(datetime.datetime.now()-datetime.timedelta(days=11))
+        os.utime(tmpfile.name, (mtime, mtime))
         fname = basename(tmpfile.name)
         args = parser.parse_args(['list', tempfile.gettempdir(),
                                   '-p',fname,'-o','10d',])
@@ -31,6 +31,23 @@ def test_list_older_than(getmtime):
         found = args.func(args) 
         assert not found
 
+def test_list_json(capsys):
+    rootdir = tempfile.mkdtemp()
+    try:
+        for i in range(3):
+            with open(join(rootdir, 'file%d' % i), 'w') as f:
+                f.write('x'*10)
+        args = parser.parse_args(['list', rootdir, '--json'])
+        assert args.func(args) == 3
+        out, err = capsys.readouterr()
+        lines = sorted(out.splitlines())
+        assert json.loads(lines[0]) == dict(path=join(rootdir, 'file0'), size=10,
+                                            rule=None, operation=None)
+        assert len(lines) == 3
+        assert '3 file(s), 30 bytes' in err
+    finally:
+        shutil.rmtree(rootdir)
+
 class CleanFilesTestCase(unittest.TestCase):
     def setUp(self):
         self.rootdir = tempfile.mkdtemp()
@@ -39,6 +56,13 @@ class CleanFilesTestCase(unittest.TestCase):
         if exists(self.rootdir): 
             shutil.rmtree(self.rootdir)
 
+    def test_clean_files_with_workers(self):
+        subdir = tempfile.mkdtemp(dir=self.rootdir)
+        files = [tempfile.mkstemp(dir=dirpath)[1] for dirpath in [self.rootdir, subdir]]
+        args = parser.parse_args(['clean',self.rootdir,'-f','-r','-d','2','-w','4'])
+        args.func(args)
+        assert not any([exists(f) for f in files])
+
     def test_clean_files_with_pattern(self):
         files = []
         for i in range(5):
@@ -0,0 +1,79 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from os.path import *
+
+from ..index import ScanIndex
+from ..utils import ScanRule, flister
+
+
+def touch(filepath, age=0):
+    if not exists(dirname(filepath)):
+        os.makedirs(dirname(filepath))
+    open(filepath, 'w').close()
+    mtime = time.time()-age
+    os.utime(filepath, (mtime, mtime))
+
+class ScanIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp()
+        self.dbpath = join(tempfile.mkdtemp(), 'index.sqlite')
+        for d in ['a', 'b', join('b', 'c')]:
+            touch(join(self.rootdir, d, 'old.txt'), age=3600)
+            touch(join(self.rootdir, d, 'new.txt'))
+        os.makedirs(join(self.rootdir, 'empty'))
+        self.options = dict(rootdir=self.rootdir, older_than='10m',
+                            recursive=True, patterns=[r'.+\.txt'])
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+        shutil.rmtree(dirname(self.dbpath))
+
+    def scan(self, **kwargs):
+        options = dict(self.options, **kwargs)
+        index = ScanIndex(self.dbpath)
+        try:
+            return sorted(e.path for e in index.iscan(ScanRule(**options)))
+        finally:
+            index.close()
+
+    def test_same_as_flister(self):
+        expected = sorted(flister(**self.options))
+        assert self.scan() == expected
+        # from the index
+        assert self.scan() == expected
+
+    def test_only_changed_directories_are_listed(self):
+        rule = ScanRule(**self.options)
+        index = ScanIndex(self.dbpath)
+        try:
+            assert index.refresh(rule) == (5, 0)
+            assert index.refresh(rule) == (0, 5)
+            touch(join(self.rootdir, 'b', 'c', 'other.txt'), age=3600)
+            assert index.refresh(rule) == (1, 4)
+        finally:
+            index.close()
+        assert join(self.rootdir, 'b', 'c', 'other.txt') in self.scan()
+
+    def test_modified_files_are_revalidated(self):
+        self.scan()
+        filepath = join(self.rootdir, 'a', 'old.txt')
+        # content change keeps directory mtime
+        mtime = time.time()
+        os.utime(filepath, (mtime, mtime))
+        assert filepath not in self.scan()
+
+    def test_removed_files(self):
+        self.scan()
+        shutil.rmtree(join(self.rootdir, 'b'))
+        assert self.scan() == [join(self.rootdir, 'a', 'old.txt'),
+                               join(self.rootdir, 'empty')]
+
+    def test_patterns_and_depth(self):
+        self.scan()
+        assert self.scan(patterns=[r'new\.txt'], older_than=None, max_depth=2) ==\
+                [join(self.rootdir, 'a', 'new.txt'), join(self.rootdir, 'b', 'new.txt'),
+                 join(self.rootdir, 'empty')]
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from os.path import *
+
+from ..journal import RunJournal
+from ..utils import archive
+
+
+class RunJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+        self.path = join(self.rootdir, 'rule.journal')
+        self.files = [tempfile.mkstemp(dir=self.rootdir)[1] for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+        shutil.rmtree(self.dest)
+
+    def test_new_run(self):
+        journal = RunJournal(self.path)
+        assert journal.recover() == (0, 0)
+        assert list(journal.skip_done(self.files)) == self.files
+        journal.complete()
+        assert not exists(self.path)
+
+    def test_resume(self):
+        journal = RunJournal(self.path, sync_every=2)
+        journal.recover()
+        result = archive(self.files[:3], self.dest, action='copy', journal=journal)
+        assert result.files == 3
+        # killed while copying the 4th file
+        tmp_file = join(self.dest, basename(self.files[3])+'.abcdefgh')
+        open(tmp_file, 'w').close()
+        journal.temp(tmp_file)
+        journal.file.write('D "%s' % self.files[3])
+        journal.close()
+
+        journal = RunJournal(self.path)
+        assert journal.recover() == (3, 1)
+        assert not exists(tmp_file)
+        assert list(journal.skip_done(self.files)) == self.files[3:]
+        assert journal.skipped == 3
+        journal.complete()
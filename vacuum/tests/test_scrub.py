@@ -4,7 +4,7 @@ import logging
 import docker
 import datetime
 
-from ..scrub import WhaleScrubber
+from ..scrub import WhaleScrubber, IgnoreMatcher
 from ..utils import pastdt
 
 class TestWhaleScrubber(unittest.TestCase):
@@ -131,4 +131,190 @@ class TestWhaleScrubber(unittest.TestCase):
         images_class.return_value = images
         filters = [{'name':'bla'}]
         self.scrubber._clean_images(filters=filters) 
-        images.list.assert_called_with(name='bla', filters={})
\ No newline at end of file
+        images.list.assert_called_with(name='bla', filters={})
+
+class WhaleScrubberWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.scrubber = WhaleScrubber(client=self.client, workers=4)
+
+    def make_images(self, n):
+        images = []
+        for i in range(n):
+            image = mock.MagicMock()
+            image.tags = ['test/image:%d' % i]
+            image.id = 'id%d' % i
+            images.append(image)
+        return images
+
+    def test_clean_images_workers(self):
+        images = self.make_images(20)
+        self.client.images.list.return_value = images
+        self.client.images.remove.side_effect = [docker.errors.APIError('in use')]+[None]*19
+        self.scrubber.logger = mock.MagicMock()
+        self.scrubber._clean_images(ignore=['test/image:1$'])
+        removed = sorted(call[0][0] for call in self.client.images.remove.call_args_list)
+        assert removed == sorted(image.id for image in images if image.id != 'id1')
+        # errors are still logged per image
+        self.scrubber.logger.warning.assert_called_once()
+
+    def test_containers_before_images(self):
+        calls = []
+        container = mock.MagicMock()
+        container.remove.side_effect = lambda **kwargs: calls.append('container')
+        self.client.containers.list.return_value = [container]*5
+        self.client.images.list.return_value = self.make_images(5)
+        self.client.images.remove.side_effect = lambda *args, **kwargs: calls.append('image')
+        self.scrubber.containers = {'workers': 2}
+        self.scrubber.images = {'force': True}
+        self.scrubber.run()
+        assert calls == ['container']*5+['image']*5
+
+    def make_image(self, id, parent='', tags=None):
+        image = mock.MagicMock()
+        image.id = id
+        image.tags = tags if tags is not None else ['test/%s:latest' % id]
+        image.attrs = {'Parent': parent}
+        return image
+
+    def set_graph(self, images, used=()):
+        # low level listings the image graph is built from
+        self.client.api.images.return_value = [
+            {'Id': i.id, 'ParentId': i.attrs['Parent'], 'RepoTags': i.tags or None}
+                                                                for i in images]
+        self.client.api.containers.return_value = [{'ImageID': i} for i in used]
+
+    def test_clean_images_leaves_first(self):
+        # base <- mid <- (leaf1, leaf2), other used by a container
+        images = [self.make_image('base'), self.make_image('mid', 'base'),
+                  self.make_image('leaf1', 'mid'), self.make_image('leaf2', 'mid'),
+                  self.make_image('other')]
+        self.set_graph(images, used=['other'])
+        self.client.images.list.return_value = images
+        removed = []
+        def remove(image_id, force=False):
+            # docker refuses parents with children
+            if any(i.attrs['Parent'] == image_id and i.id not in removed for i in images):
+                raise docker.errors.APIError('image has dependent child images')
+            removed.append(image_id)
+        self.client.images.remove.side_effect = remove
+        self.scrubber.logger = mock.MagicMock()
+        self.scrubber._clean_images()
+        assert sorted(removed[:2]) == ['leaf1', 'leaf2']
+        assert removed[2:] == ['mid', 'base']
+        self.scrubber.logger.warning.assert_not_called()
+        self.client.images.list.assert_called_with()
+
+    def test_clean_images_untagged_intermediates(self):
+        # base <- i1 <- i2 <- leaf, i1 and i2 untagged intermediate images
+        images = [self.make_image('base'), self.make_image('i1', 'base', []),
+                  self.make_image('i2', 'i1', []), self.make_image('leaf', 'i2')]
+        self.set_graph(images)
+        self.client.images.list.return_value = [images[0], images[3]]
+        removed = []
+        def remove(image_id, force=False):
+            if any(i.attrs['Parent'] == image_id and i.id not in removed for i in images):
+                raise docker.errors.APIError('image has dependent child images')
+            removed.append(image_id)
+            if image_id == 'leaf':
+                # docker removes the untagged parents too
+                removed.extend(['i2', 'i1'])
+        self.client.images.remove.side_effect = remove
+        self.scrubber.logger = mock.MagicMock()
+        self.scrubber._clean_images()
+        assert removed == ['leaf', 'i2', 'i1', 'base']
+        self.scrubber.logger.warning.assert_not_called()
+        # nothing inspected one by one
+        self.client.images.list.assert_called_once_with()
+        self.client.containers.list.assert_not_called()
+
+    def test_clean_images_keeps_parents_of_ignored(self):
+        images = [self.make_image('base'), self.make_image('leaf', 'base')]
+        self.set_graph(images)
+        self.client.images.list.return_value = images
+        self.scrubber._clean_images(ignore=['test/leaf'])
+        self.client.images.remove.assert_not_called()
+
+    def test_prune_exited_containers(self):
+        self.client.containers.prune.return_value = {'ContainersDeleted': ['a', 'b'],
+                                                     'SpaceReclaimed': 1024}
+        filters = [{'status': 'exited', 'older_than': '2d', 'label': 'ci'}]
+        self.scrubber._clean_containers(filters=filters)
+        prune = self.client.containers.prune.call_args[1]['filters']
+        assert prune['label'] == 'ci'
+        than = datetime.datetime.utcfromtimestamp(int(prune['until']))
+        assert abs((pastdt('2d', utc=True)-than).total_seconds()) < 5
+        self.client.containers.list.assert_not_called()
+        assert self.scrubber.space_reclaimed == 1024
+
+    def test_no_prune_without_age(self):
+        self.client.containers.list.return_value = []
+        self.scrubber._clean_containers(filters=[{'status': 'exited'}])
+        self.client.containers.prune.assert_not_called()
+        self.client.containers.list.assert_called_with(all=True, filters={'status': 'exited'})
+
+    def test_prune_dangling_images(self):
+        self.client.images.prune.return_value = {'ImagesDeleted': None, 'SpaceReclaimed': 0}
+        self.scrubber._clean_images(filters=[{'dangling': True}])
+        self.client.images.prune.assert_called_with(filters={'dangling': True})
+        self.client.images.list.assert_not_called()
+
+    def test_no_prune_with_ignores(self):
+        self.client.containers.list.return_value = []
+        filters = [{'status': 'exited'}]
+        self.scrubber._clean_containers(ignore=['keep'], filters=filters)
+        self.client.containers.prune.assert_not_called()
+        self.client.containers.list.assert_called_with(all=True, filters={'status': 'exited'})
+        # name filters are applied client side
+        self.client.images.list.return_value = []
+        self.scrubber._clean_images(filters=[{'dangling': True, 'name': 'test/image'}])
+        self.client.images.prune.assert_not_called()
+
+
+    def test_budget_oldest_unused_first(self):
+        mb = 1024*1024
+        # old <- child (newest), used has a container, kept is ignored
+        self.client.df.return_value = {'LayersSize': 100*mb, 'Images': [
+            {'Id': 'old', 'ParentId': '', 'Created': 1, 'Size': 30*mb, 'SharedSize': 0,
+             'Containers': 0, 'RepoTags': ['test/old:1']},
+            {'Id': 'child', 'ParentId': 'old', 'Created': 9, 'Size': 50*mb, 'SharedSize': 30*mb,
+             'Containers': 0, 'RepoTags': ['test/child:1']},
+            {'Id': 'used', 'ParentId': '', 'Created': 2, 'Size': 10*mb, 'SharedSize': 0,
+             'Containers': 1, 'RepoTags': ['test/used:1']},
+            {'Id': 'kept', 'ParentId': '', 'Created': 3, 'Size': 10*mb, 'SharedSize': 0,
+             'Containers': 0, 'RepoTags': ['test/kept:1']},
+            {'Id': 'recent', 'ParentId': '', 'Created': 5, 'Size': 15*mb, 'SharedSize': 0,
+             'Containers': 0, 'RepoTags': ['test/recent:1']},
+            {'Id': 'newest', 'ParentId': '', 'Created': 10, 'Size': 5*mb, 'SharedSize': 0,
+             'Containers': 0, 'RepoTags': ['test/newest:1']}]}
+        self.scrubber.workers = 1
+        self.scrubber._clean_images(ignore=['test/kept'], budget='60M')
+        removed = [call[0][0] for call in self.client.images.remove.call_args_list]
+        # old only becomes removable once child is gone, stops once within budget
+        assert removed == ['recent', 'child', 'old']
+        self.client.images.list.assert_not_called()
+
+    def test_budget_within(self):
+        self.client.df.return_value = {'LayersSize': 1024, 'Images': []}
+        self.scrubber._clean_images(budget='1K')
+        self.client.images.remove.assert_not_called()
+
+def test_ignore_matcher():
+    ignores = IgnoreMatcher(['test/scrub', 'example.+', 'dedicated'])
+    assert ignores.matches(['other:1', 'test/scrub:willmatch'])
+    assert ignores.matches('dedicated.31nzx33t42ga')
+    assert not ignores.matches(['notmatcher', 'example'])
+    assert not ignores.matches([])
+    assert ignores.cache == {'other:1': False, 'test/scrub:willmatch': True,
+                             'dedicated.31nzx33t42ga': True, 'notmatcher': False,
+                             'example': False}
+    assert not IgnoreMatcher([]).matches('anything')
+    assert len(IgnoreMatcher([])) == 0
+
+def test_ignore_matcher_cache_size():
+    ignores = IgnoreMatcher(['keep'], cache_size=2)
+    for name in ['a', 'b', 'keep', 'c']:
+        ignores.matches(name)
+    assert len(ignores.cache) <= 2
+    assert ignores.matches('keep')
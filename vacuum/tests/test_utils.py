@@ -8,8 +8,13 @@ import shutil
 import stat
 import six
 import string
+import re
+import json
+import tarfile
+import errno
 
 from ..utils import *
+import vacuum.utils
 
 def test_pastdt():
     past = pastdt('10s')
@@ -81,6 +86,82 @@ def test_flister_recursive_max_depth_default():
                 filelist = list(flister(tmpdir1, 'xyz', recursive=True, max_depth=-1))
     assert len(filelist) == 3
 
+def test_flister_multiple_patterns_once():
+    tmpdir1 = tempfile.mkdtemp()
+    tmpdir2 = tempfile.mkdtemp(dir=tmpdir1)
+    try:
+        _, tmpfile = tempfile.mkstemp(prefix='xyz', suffix='.nc', dir=tmpdir2)
+        patterns = ['xyz', r'.+\.nc$', 'abc']
+        with mock.patch('vacuum.utils.scandir', wraps=os.scandir) as scandir:
+            filelist = list(flister(tmpdir1, patterns, recursive=True))
+        assert filelist == [tmpfile]
+        assert scandir.call_count == 2
+    finally:
+        shutil.rmtree(tmpdir1)
+
+def test_flister_workers():
+    tmpdir1 = tempfile.mkdtemp()
+    try:
+        dirs = [tmpdir1]
+        for i in range(4):
+            dirs.append(tempfile.mkdtemp(dir=dirs[-1]))
+            dirs.append(tempfile.mkdtemp(dir=dirs[-2], prefix='.'))
+        for dirpath in dirs:
+            tempfile.mkstemp(dir=dirpath)
+            tempfile.mkstemp(dir=dirpath, prefix='.')
+        tempfile.mkdtemp(dir=dirs[3])
+        for max_depth in [-1, 1, 3]:
+            for include_hidden in [True, False]:
+                options = dict(recursive=True, max_depth=max_depth,
+                               include_hidden=include_hidden)
+                expected = sorted(flister(tmpdir1, **options))
+                assert expected
+                assert sorted(flister(tmpdir1, workers=4, **options)) == expected
+    finally:
+        shutil.rmtree(tmpdir1)
+
+def make_dated_tree(rootdir, days=(1, 5, 10)):
+    dated = []
+    for day in days:
+        dt = datetime.datetime.now()-datetime.timedelta(days=day)
+        dirpath = os.path.join(rootdir, 'nz', dt.strftime('%Y%m%d'))
+        os.makedirs(os.path.join(dirpath, 'sub'))
+        for hour in [0, 12]:
+            open(os.path.join(dirpath, 'sub', 'roms_%02dz.nc' % hour), 'w').close()
+        dated.append(dirpath)
+    return dated
+
+def test_flister_dated_dirs():
+    rootdir = tempfile.mkdtemp()
+    try:
+        recent, old, older = make_dated_tree(rootdir)
+        options = dict(older_than='3d', recursive=True, date_strptime='%Y%m%d',
+                       time_strptime='%Hz')
+        files = sorted(flister(rootdir, **options))
+        assert len(files) == 4
+        assert all(f.startswith((old, older)) for f in files)
+        with mock.patch('vacuum.utils.scandir', wraps=os.scandir) as scandir:
+            assert sorted(flister(rootdir, dated_dirs=True, **options)) == sorted([old, older])
+        # root and rootdir/nz only
+        assert scandir.call_count == 2
+        # not all files taken, expired directories are listed
+        assert sorted(flister(rootdir, dated_dirs=True, patterns=[r'.+\.nc$'],
+                              **options)) == files
+    finally:
+        shutil.rmtree(rootdir)
+
+def test_pattern_matcher():
+    patterns = [r'.+\.nc$', r'wrf_\d+\.grb$', r'(?i)README']
+    matcher = PatternMatcher(patterns)
+    for name in ['a.nc', 'wrf_01.grb', 'readme.txt', 'a.nc.bak', 'wrf_x.grb', 'b.txt']:
+        expected = any(re.match(pattern, name) for pattern in patterns)
+        assert matcher.match(name) == expected
+    matcher = PatternMatcher(['xyz', r'abc.+\.nc$'])
+    assert matcher.prefixes == ('xyz', 'abc')
+    assert matcher.suffixes is None
+    assert matcher.match('xyz.nc') and matcher.match('abc1.nc')
+    assert not matcher.match('zyx.nc')
+
 def test_flister_default():
     assert list(flister(os.path.dirname(__file__)))
     assert not list(flister('/nonexistent'))
@@ -93,22 +174,20 @@ def test_flister_empty_dirs():
     with tempfile.NamedTemporaryFile(prefix='xyz', dir=tmpdir12) as tmpfile1:
         assert len(list(flister(tmpdir1, 'abc', recursive=True, max_depth=3))) == 1
 
-@mock.patch('vacuum.utils.getmtime')
-def test_flister_older_than(getmtime):
-    getmtime.return_value = timestamp(datetime.datetime.now()\
-                            - datetime.timedelta(days=4))
+def set_mtime(filename, mtime):
+    os.utime(filename, (os.stat(filename).st_atime, timestamp(mtime)))
 
+def test_flister_older_than():
     with tempfile.NamedTemporaryFile() as tmpfile:
+        set_mtime(tmpfile.name, datetime.datetime.now()-datetime.timedelta(days=4))
         filename = os.path.basename(tmpfile.name)
         root = os.path.dirname(tmpfile.name)
         assert len(list(flister(root, filename, older_than='2d'))) == 1
         assert len(list(flister(root, filename, older_than='10d'))) == 0
 
-@mock.patch('vacuum.utils.getmtime')
-def test_flister_older_than_with_relative_time(getmtime):
-    getmtime.return_value = timestamp(datetime.datetime.now()\
-                            - datetime.timedelta(days=4))
+def test_flister_older_than_with_relative_time():
     with tempfile.NamedTemporaryFile() as tmpfile:
+        set_mtime(tmpfile.name, datetime.datetime.now()-datetime.timedelta(days=4))
         filename = os.path.basename(tmpfile.name)
         root = os.path.dirname(tmpfile.name)
         assert len(list(flister(root, filename, older_than='2d', 
@@ -122,6 +201,110 @@ def test_flister_hidden():
         assert tmpfile.name in flister(root, include_hidden=True)
         assert tmpfile.name not in flister(root, include_hidden=False)
 
+def test_flister_hidden_recursive():
+    tmpdir1 = tempfile.mkdtemp()
+    tmpdir2 = tempfile.mkdtemp(dir=tmpdir1)
+    try:
+        _, hidden = tempfile.mkstemp(prefix='.', dir=tmpdir2)
+        _, visible = tempfile.mkstemp(dir=tmpdir2)
+        files = list(flister(tmpdir1, recursive=True, include_hidden=False))
+        assert files == [visible]
+    finally:
+        shutil.rmtree(tmpdir1)
+
+def test_flister_rootdir_glob():
+    tmpdir1 = tempfile.mkdtemp()
+    tmpdir2 = tempfile.mkdtemp(dir=tmpdir1)
+    tmpdir3 = tempfile.mkdtemp(dir=tmpdir1)
+    try:
+        _, tmpfile1 = tempfile.mkstemp(dir=tmpdir1)
+        _, tmpfile2 = tempfile.mkstemp(dir=tmpdir2)
+        _, tmpfile3 = tempfile.mkstemp(dir=tmpdir3)
+        files = list(flister(os.path.join(tmpdir1, '*')))
+        assert sorted(files) == sorted([tmpfile2, tmpfile3])
+    finally:
+        shutil.rmtree(tmpdir1)
+
+def test_iscan_entries():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+        with open(tmpfile, 'w') as of:
+            of.write('vacuum')
+        entries = list(iscan(tmpdir))
+        assert len(entries) == 1
+        assert entries[0].path == tmpfile
+        assert entries[0].stat().st_size == 6
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_iscan_rules_overlapping_roots():
+    tmpdir1 = tempfile.mkdtemp()
+    tmpdir2 = tempfile.mkdtemp(dir=tmpdir1)
+    try:
+        _, tmpfile1 = tempfile.mkstemp(suffix='.txt', dir=tmpdir1)
+        _, tmpfile2 = tempfile.mkstemp(suffix='.nc', dir=tmpdir2)
+        rules = [ScanRule(tmpdir1, '.+\\.txt', recursive=True),
+                 ScanRule(os.path.join(tmpdir1, '*'), '.+\\.nc'),
+                 ScanRule(tmpdir1, recursive=True)]
+        with mock.patch('vacuum.utils.scandir', wraps=os.scandir) as scandir:
+            found = dict((entry.path, indexes) 
+                         for entry, indexes in iscan_rules(rules))
+        assert scandir.call_count == 2
+        assert found == {tmpfile1: [0, 2], tmpfile2: [1, 2]}
+    finally:
+        shutil.rmtree(tmpdir1)
+
+def test_iscan_rules_workers():
+    tmpdir1 = tempfile.mkdtemp()
+    tmpdir2 = tempfile.mkdtemp(dir=tmpdir1)
+    try:
+        _, tmpfile1 = tempfile.mkstemp(suffix='.txt', dir=tmpdir1)
+        _, tmpfile2 = tempfile.mkstemp(suffix='.nc', dir=tmpdir2)
+        rules = [ScanRule(tmpdir1, '.+\\.txt', recursive=True),
+                 ScanRule(os.path.join(tmpdir1, '*'), '.+\\.nc'),
+                 ScanRule(tmpdir1, recursive=True)]
+        found = dict((entry.path, indexes) 
+                     for entry, indexes in iscan_rules(rules, workers=3))
+        assert found == {tmpfile1: [0, 2], tmpfile2: [1, 2]}
+    finally:
+        shutil.rmtree(tmpdir1)
+
+def test_iscan_rules_unreached_root():
+    tmpdir1 = tempfile.mkdtemp()
+    tmpdir2 = tempfile.mkdtemp(dir=tmpdir1)
+    try:
+        _, tmpfile1 = tempfile.mkstemp(dir=tmpdir1)
+        _, tmpfile2 = tempfile.mkstemp(dir=tmpdir2)
+        rules = [ScanRule(tmpdir1), ScanRule(tmpdir2)]
+        found = dict((entry.path, indexes) 
+                     for entry, indexes in iscan_rules(rules))
+        assert found == {tmpfile1: [0], tmpfile2: [1]}
+    finally:
+        shutil.rmtree(tmpdir1)
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_iscan_rules_dated_dirs_nested_root(workers):
+    rootdir = tempfile.mkdtemp()
+    try:
+        recent, old, older = make_dated_tree(rootdir)
+        options = dict(older_than='3d', recursive=True, date_strptime='%Y%m%d',
+                       dated_dirs=True)
+        rules = [ScanRule(rootdir, **options),
+                 ScanRule(older, recursive=True),
+                 ScanRule(os.path.join(old, 'sub'))]
+        found = dict((entry.path, indexes)
+                     for entry, indexes in iscan_rules(rules, workers))
+        # no directory is taken whole while a rule is rooted in it
+        files = [os.path.join(dirpath, 'sub', 'roms_%02dz.nc' % hour)
+                 for dirpath in (old, older) for hour in (0, 12)]
+        assert found == {files[0]: [0, 2], files[1]: [0, 2],
+                         files[2]: [0, 1], files[3]: [0, 1]}
+        rules = [ScanRule(rootdir, **options)]
+        assert sorted(entry.path for entry, _ in iscan_rules(rules, workers)) == sorted([old, older])
+    finally:
+        shutil.rmtree(rootdir)
+
 def test_delete_link():
     tmpfile = tempfile.NamedTemporaryFile()
     tmpfilelnk = tmpfile.name+'.lnk'
@@ -163,6 +346,184 @@ def test_delete_empty_dir():
     delete([tmpfile], delete_empty=True)
     assert not os.path.isdir(tmpdir)
 
+def test_delete_workers():
+    tmpdir = tempfile.mkdtemp()
+    subdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        files = [tempfile.mkstemp(dir=subdir)[1] for i in range(20)]
+        emptydir = tempfile.mkdtemp(dir=tmpdir)
+        result = delete(iter(files+[emptydir]), delete_empty=True, workers=4,
+                        keep_paths=True)
+        assert sorted(result.file_paths) == sorted(files)
+        assert sorted(result.directory_paths) == sorted([emptydir, subdir, tmpdir])
+        assert not result.errors
+        assert not os.path.exists(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def test_operation_result():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(5):
+            _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+            with open(tmpfile, 'w') as f:
+                f.write('x'*10)
+            files.append(tmpfile)
+        result = delete(files)
+        assert (result.files, result.bytes, result.errors) == (5, 50, 0)
+        assert result.file_paths is None
+        result = OperationResult(max_errors=2)
+        for filepath in files:
+            result.add_error(filepath, OSError('Not permitted'))
+        assert result.errors == 5
+        assert len(result.error_sample) == 2
+        assert result.format_errors().endswith('... and 3 more')
+    finally:
+        shutil.rmtree(tmpdir)
+
+def fake_statvfs(files, free=1000, size=10000):
+    """ statvfs of a 1 byte block filesystem where removed `files` free space """
+    def statvfs(path):
+        freed = sum(100 for f in files if not os.path.exists(f))
+        return mock.Mock(f_frsize=1, f_blocks=size, f_bavail=free+freed)
+    return statvfs
+
+def test_free_space_plan():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = []
+        for hours in [3, 5, 1, 4, 2]:
+            _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+            with open(tmpfile, 'w') as f:
+                f.write('x'*100)
+            set_mtime(tmpfile, datetime.datetime.now()-datetime.timedelta(hours=hours))
+            files.append(tmpfile)
+        with mock.patch('os.statvfs', side_effect=fake_statvfs(files)):
+            # 250 bytes missing, the 3 oldest are enough
+            plan = free_space_plan(iscan(tmpdir), tmpdir, target_free_bytes=1250)
+            planned = []
+            for entry in plan:
+                planned.append(entry.path)
+                os.remove(entry.path)
+            assert planned == [files[1], files[3], files[0]]
+            # met, nothing more to remove
+            assert list(free_space_plan(iscan(tmpdir), tmpdir, target_free='10%')) == []
+            # never met (i.e. dry-run), all planned files
+            plan = free_space_plan(iscan(tmpdir), tmpdir, target_free='15%')
+            assert [entry.path for entry in plan] == [files[4], files[2]]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_parse_size():
+    assert parse_size(100) == 100
+    assert parse_size('100') == 100
+    assert parse_size('1.5K') == 1536
+    assert parse_size('10G') == 10*1024**3
+    assert parse_size('2 MiB') == 2*1024**2
+    with pytest.raises(ValueError):
+        parse_size('ten')
+
+def test_quota_plan():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = []
+        for minutes in [150, 10, 20, 300, 30, 75]:
+            _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+            with open(tmpfile, 'w') as f:
+                f.write('x'*100)
+            set_mtime(tmpfile, datetime.datetime.now()-datetime.timedelta(minutes=minutes))
+            files.append(tmpfile)
+        plan = [entry.path for entry in quota_plan(iscan(tmpdir), '250')]
+        # the 2 newest kept
+        assert sorted(plan) == sorted([files[0], files[3], files[4], files[5]])
+        assert list(quota_plan(iscan(tmpdir), '1K')) == []
+        assert len(list(quota_plan(iscan(tmpdir), 0))) == 6
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_quota_plan_boundary_hour():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        hour = datetime.datetime(2020, 1, 1, 12)
+        files = []
+        for seconds in [10, 70, 75, 200, 1800, 1801, 1801]:
+            _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+            with open(tmpfile, 'w') as f:
+                f.write('x'*100)
+            set_mtime(tmpfile, hour+datetime.timedelta(seconds=seconds))
+            files.append(tmpfile)
+        with mock.patch('tempfile.TemporaryFile', wraps=tempfile.TemporaryFile) as spill:
+            plan = [entry.path for entry in quota_plan(iscan(tmpdir), '350')]
+        # all in one hour, narrowed down by minute then second
+        assert spill.call_count == 3
+        assert sorted(plan) == sorted(files[:4])
+        plan = [entry.path for entry in quota_plan(iscan(tmpdir), '150')]
+        # one of the newest, within the same second
+        assert len(plan) == 6 and files[4] in plan
+    finally:
+        shutil.rmtree(tmpdir)
+
+@mock.patch('os.remove', side_effect=OSError('Not permitted'))
+def test_delete_workers_errors(remove):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = [tempfile.mkstemp(dir=tmpdir)[1] for i in range(5)]
+        result = delete(files, workers=2)
+        assert not result.files
+        assert sorted(result.error_sample) == sorted(files)
+        with pytest.raises(OSError):
+            delete(files, workers=2, raise_errors=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_delete_empty_ancestors():
+    rootdir = tempfile.mkdtemp()
+    try:
+        dirs = [tempfile.mkdtemp(dir=rootdir)]
+        for i in range(3):
+            dirs.append(tempfile.mkdtemp(dir=dirs[-1]))
+        keep = tempfile.mkdtemp(dir=dirs[0])
+        _, kept = tempfile.mkstemp(dir=keep)
+        files = [tempfile.mkstemp(dir=dirpath)[1] for dirpath in dirs[2:] for i in range(3)]
+        with mock.patch('os.rmdir', wraps=os.rmdir) as rmdir:
+            result = delete(files, delete_empty=True, rootdir=rootdir, keep_paths=True)
+        assert sorted(result.directory_paths) == sorted(dirs[1:])
+        # dirs[0] (not empty) is tried once and its parents not at all
+        assert sorted(call[0][0] for call in rmdir.call_args_list) == sorted(dirs)
+        assert os.path.exists(kept)
+    finally:
+        shutil.rmtree(rootdir)
+
+def test_archive_delete_empty():
+    rootdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        subdir = tempfile.mkdtemp(dir=rootdir)
+        files = [tempfile.mkstemp(dir=subdir)[1] for i in range(10)]
+        with mock.patch('os.rmdir', wraps=os.rmdir) as rmdir:
+            result = archive(files, dest, action='move', delete_empty=True,
+                             rootdir=rootdir, keep_paths=True)
+        assert result.directory_paths == [subdir]
+        assert rmdir.call_count == 1
+        # the rule root is kept
+        assert os.path.isdir(rootdir)
+    finally:
+        shutil.rmtree(rootdir)
+        shutil.rmtree(dest)
+
+def test_delete_empty_keeps_root():
+    rootdir = tempfile.mkdtemp()
+    try:
+        subdir = os.path.join(rootdir, 'a', 'b')
+        os.makedirs(subdir)
+        _, tmpfile = tempfile.mkstemp(dir=subdir)
+        result = delete([tmpfile], delete_empty=True, rootdir=rootdir, keep_paths=True)
+        assert result.directory_paths == [subdir, os.path.dirname(subdir)]
+        assert os.path.isdir(rootdir)
+    finally:
+        shutil.rmtree(rootdir)
+
 @mock.patch('shutil.rmtree')
 def test_delete_error(rmtree):
     tmpdir = tempfile.mkdtemp()
@@ -195,6 +556,23 @@ def test_datetime_from_filename_parser():
     expected = datetime.datetime(2018,1,13,0)
     assert path2dt(example, date_strptime='%Y%m%d') == expected
 
+def test_datetime_from_filename_parser_invalid():
+    assert path2dt('/data/wrf20181340/file.nc', date_strptime='%Y%m%d') is None
+    assert path2dt('/data/wrf/file.nc', date_strptime='%Y%m%d') is None
+    expected = datetime.datetime(2018,1,14)
+    assert path2dt('/data/wrf180114/file.nc', date_strptime='%y%m%d') == expected
+    assert path2dt('/data/2018/01/14/file.nc', date_strptime='%Y/%m/%d') == expected
+    assert path2dt('/data/2018.01.14/file.nc', date_strptime='%Y.%m.%d') == expected
+    assert path2dt('/data/2018-014/file.nc', date_strptime='%Y-%j') == expected
+
+def test_date_extractor_memoizes_directories():
+    dates = DateExtractor('%Y%m%d', '%Hz')
+    with mock.patch.object(dates.date, '_parse', wraps=dates.date._parse) as parse:
+        for hour in range(24):
+            path = '/data/roms/nz/20240101/roms_%02dz.nc' % hour
+            assert dates(path) == datetime.datetime(2024,1,1,hour)
+    assert parse.call_count == 1
+
 def test_archive_simple():
     tmpdir = tempfile.mkdtemp()
     try:
@@ -207,6 +585,383 @@ def test_archive_simple():
         shutil.rmtree(tmpdir)
 
 
+def test_copy_file():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _, src = tempfile.mkstemp(dir=tmpdir)
+        with open(src, 'wb') as of:
+            of.write(os.urandom(3*1024*1024+7))
+        set_mtime(src, datetime.datetime(2000,1,1))
+        dst = src+'.copy'
+        copy_file(src, dst)
+        assert open(src, 'rb').read() == open(dst, 'rb').read()
+        assert os.stat(src).st_mtime == os.stat(dst).st_mtime
+    finally:
+        shutil.rmtree(tmpdir)
+
+@mock.patch('shutil.copyfile')
+@mock.patch('os.copy_file_range', side_effect=OSError(18, 'Invalid cross-device link'),
+            create=True)
+@mock.patch('vacuum.utils._reflink', return_value=False)
+def test_copy_file_fallback(reflink, copy_file_range, copyfile):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _, src = tempfile.mkstemp(dir=tmpdir)
+        with open(src, 'w') as of:
+            of.write('vacuum')
+        copy_file(src, src+'.copy')
+        copyfile.assert_called_with(src, src+'.copy')
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_archive_workers():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = [tempfile.mkstemp(dir=tmpdir)[1] for i in range(20)]
+        result = archive(iter(files), dest, action='move', workers=4, keep_paths=True)
+        assert sorted(result.file_paths) == sorted(files)
+        assert not result.errors
+        assert not os.listdir(tmpdir)
+        assert sorted(os.listdir(dest)) == sorted(map(os.path.basename, files))
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_archive_compare():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(3):
+            _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+            with open(tmpfile, 'w') as f:
+                f.write('abc')
+            files.append(tmpfile)
+        assert archive(files, dest, action='copy', compare='mtime').files == 3
+        with mock.patch('vacuum.utils.copy_file', wraps=copy_file) as copy:
+            result = archive(files, dest, action='copy', compare='mtime')
+            assert (result.files, result.skipped) == (0, 3)
+            assert not copy.called
+            # same size and mtime, different content
+            mtime = os.stat(files[0]).st_mtime
+            with open(files[0], 'w') as f:
+                f.write('xyz')
+            os.utime(files[0], (mtime, mtime))
+            assert archive(files, dest, action='copy', compare='mtime').skipped == 3
+            result = archive(files, dest, action='copy', compare='checksum')
+            assert (result.files, result.skipped) == (1, 2)
+            assert copy.call_count == 1
+        with open(os.path.join(dest, os.path.basename(files[0]))) as f:
+            assert f.read() == 'xyz'
+        # on the same device moves are renames, nothing to compare
+        with mock.patch('vacuum.utils._unchanged') as unchanged:
+            result = archive(files, dest, action='move', compare='mtime')
+        assert (result.files, result.skipped) == (3, 0)
+        assert not unchanged.called
+        assert not any(os.path.exists(f) for f in files)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_archive_dedup():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = []
+        for cycle in ['cycle1', 'cycle2']:
+            os.makedirs(os.path.join(tmpdir, cycle))
+            for name, content in [('grid', 'static'), ('output', cycle)]:
+                filepath = os.path.join(tmpdir, cycle, name)
+                with open(filepath, 'w') as f:
+                    f.write(content)
+                files.append(filepath)
+        root_depth = len(tmpdir.split(os.sep))-1
+        with mock.patch('vacuum.utils._file_digest', wraps=vacuum.utils._file_digest) as digest:
+            result = archive(files, dest, action='copy', root_depth=root_depth, dedup=True)
+            assert (result.files, result.bytes) == (4, 24)
+            assert digest.call_count == 4
+            grids = [os.stat(os.path.join(dest, cycle, 'grid')) for cycle in ['cycle1', 'cycle2']]
+            assert grids[0].st_ino == grids[1].st_ino
+            assert os.stat(os.path.join(dest, 'cycle1', 'output')).st_nlink == 2
+            # digests cached, sources unchanged
+            archive(files, dest, action='copy', root_depth=root_depth, dedup=True)
+            assert digest.call_count == 4
+        with open(os.path.join(dest, 'cycle2', 'output')) as f:
+            assert f.read() == 'cycle2'
+        # objects no longer archived are removed from the store
+        store = os.path.join(dest, '.vacuum-store')
+        objects = lambda: sorted(name for subdir in os.listdir(store)
+                                 if os.path.isdir(os.path.join(store, subdir))
+                                 for name in os.listdir(os.path.join(store, subdir)))
+        assert len(objects()) == 3
+        os.remove(os.path.join(dest, 'cycle1', 'output'))
+        archive([], dest, action='copy', dedup=True)
+        assert len(objects()) == 2
+        assert os.stat(os.path.join(dest, 'cycle1', 'grid')).st_nlink == 3
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_dedup_store_commits_in_batches():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = [tempfile.mkstemp(dir=tmpdir)[1] for i in range(3)]
+        store = vacuum.utils.DedupStore.open(dest)
+        assert vacuum.utils.DedupStore.open(dest) is store
+        store.commit_every = 2
+        for filepath in files:
+            store.digest(filepath, os.stat(filepath))
+        # committed before close, readable by another run
+        other = vacuum.utils.DedupStore(dest, timeout=0)
+        assert other.db.execute('SELECT COUNT(*) FROM digests').fetchone()[0] == 2
+        other.close()
+        store.close()
+        store.close()
+        store = vacuum.utils.DedupStore.open(dest)
+        assert store.users == 1
+        store.close()
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def make_bundle_tree(rootdir):
+    files = []
+    for dirname in ['20200101', '20200102']:
+        os.makedirs(os.path.join(rootdir, dirname))
+        for i in range(3):
+            filepath = os.path.join(rootdir, dirname, 'file%d' % i)
+            with open(filepath, 'w') as f:
+                f.write('x'*100*(i+1))
+            files.append(filepath)
+    return files
+
+@pytest.mark.parametrize('format', ['tar', 'tar.gz', 'tar.zst', 'zip'])
+def test_bundle_formats(format):
+    if format == 'tar.zst':
+        pytest.importorskip('zstandard')
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = make_bundle_tree(tmpdir)
+        result = archive(files, dest, action='copy', format=format, bundle_name='rule',
+                         root_depth=len(tmpdir.split(os.sep))-1)
+        assert (result.files, result.bytes, result.errors) == (6, 1200, 0)
+        assert sorted(os.listdir(dest)) == ['rule.%s' % format, 'rule.%s.index' % format]
+        with open(os.path.join(dest, 'rule.%s.index' % format)) as f:
+            index = [json.loads(line) for line in f]
+        assert [m['name'] for m in index] == [os.path.join(*f.split(os.sep)[-2:]) for f in files]
+        assert all(os.path.exists(f) for f in files)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_bundle_by_directory_move():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = make_bundle_tree(tmpdir)
+        result = archive(files, dest, action='move', format='tar.gz', bundle_by='directory',
+                         root_depth=len(tmpdir.split(os.sep))-1)
+        assert result.files == 6
+        assert not any(os.path.exists(f) for f in files)
+        with tarfile.open(os.path.join(dest, '20200101.tar.gz')) as bundle:
+            assert bundle.getnames() == ['file0', 'file1', 'file2']
+            assert bundle.extractfile('file2').read() == b'x'*300
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+class CountingBundle(Bundle):
+    opened = set()
+    most = 0
+
+    def __init__(self, *args, **kwargs):
+        Bundle.__init__(self, *args, **kwargs)
+        CountingBundle.opened.add(self)
+        CountingBundle.most = max(CountingBundle.most, len(CountingBundle.opened))
+
+    def close(self):
+        CountingBundle.opened.discard(self)
+        Bundle.close(self)
+
+@pytest.mark.parametrize('interleaved', [False, True])
+def test_bundle_by_directory_open_bundles(interleaved):
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    CountingBundle.opened, CountingBundle.most = set(), 0
+    try:
+        files = make_bundle_tree(tmpdir)
+        for dirname in ['20200103', '20200104']:
+            os.makedirs(os.path.join(tmpdir, dirname))
+            for i in range(3):
+                files.append(os.path.join(tmpdir, dirname, 'file%d' % i))
+                with open(files[-1], 'w') as f:
+                    f.write('x')
+        if interleaved:
+            # a file of each directory after the other, as a parallel scan may
+            files = [files[i+j] for i in range(3) for j in range(0, 12, 3)]
+        with mock.patch('vacuum.utils.Bundle', CountingBundle):
+            result = archive(files, dest, action='move', format='tar', bundle_by='directory',
+                             root_depth=len(tmpdir.split(os.sep))-1, max_open=2)
+        assert (result.files, result.errors) == (12, 0)
+        assert not any(os.path.exists(f) for f in files)
+        assert CountingBundle.most == (2 if interleaved else 1)
+        bundles = [f for f in os.listdir(dest) if f.endswith('.tar')]
+        members = []
+        for name in bundles:
+            with tarfile.open(os.path.join(dest, name)) as bundle:
+                members.extend((name[:8], member) for member in bundle.getnames())
+        assert len(members) == 12 and len(set(members)) == 12
+        assert len(bundles) == (12 if interleaved else 4)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_bundle_not_verified_keeps_sources():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = make_bundle_tree(tmpdir)
+        with mock.patch.object(Bundle, 'verify', side_effect=tarfile.TarError('corrupt')):
+            result = archive(files, dest, action='move', format='tar.gz')
+        assert (result.files, result.errors) == (0, 1)
+        assert all(os.path.exists(f) for f in files)
+        assert not os.listdir(dest)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+@pytest.mark.parametrize('format', ['tar.gz', 'zip'])
+def test_bundle_unreadable_member(format):
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    real_open = open
+    def failing_open(path, *args, **kwargs):
+        if path == files[1]:
+            raise IOError(13, 'Permission denied', path)
+        return real_open(path, *args, **kwargs)
+    try:
+        files = make_bundle_tree(tmpdir)
+        with mock.patch.object(six.moves.builtins, 'open', side_effect=failing_open):
+            result = archive(files, dest, action='move', format=format, bundle_name='rule')
+        assert (result.files, result.errors) == (5, 1)
+        assert list(result.error_sample) == [files[1]]
+        assert [os.path.exists(f) for f in files] == [False, True]+[False]*4
+        with open(os.path.join(dest, 'rule.%s.index' % format)) as f:
+            assert [json.loads(line)['source'] for line in f] == files[:1]+files[2:]
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+@mock.patch('vacuum.utils._copy_file_range', side_effect=OSError(28, 'No space left'))
+def test_archive_error_removes_temp(copy_file_range):
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+        with mock.patch('vacuum.utils._reflink', return_value=False):
+            result = archive([tmpfile], dest, action='copy')
+        assert list(result.error_sample) == [tmpfile]
+        assert not os.listdir(dest)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_archive_move_same_device_renames():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+        inode = os.stat(tmpfile).st_ino
+        with mock.patch('vacuum.utils.copy_file') as copy:
+            archive([tmpfile], dest, action='move')
+        copy.assert_not_called()
+        assert not os.path.exists(tmpfile)
+        assert os.stat(os.path.join(dest, os.path.basename(tmpfile))).st_ino == inode
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_archive_move_other_device_copies():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    lstat = os.lstat
+    def other_device(path):
+        st = list(lstat(path))
+        st[stat.ST_DEV] += 1
+        return os.stat_result(st)
+    try:
+        _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+        with mock.patch('os.lstat', side_effect=other_device):
+            with mock.patch('vacuum.utils.copy_file', wraps=copy_file) as copy:
+                archive([tmpfile], dest, action='move')
+        copy.assert_called()
+        assert not os.path.exists(tmpfile)
+        assert os.path.exists(os.path.join(dest, os.path.basename(tmpfile)))
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_archive_move_across_bind_mounts_copies():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    rename = os.rename
+    def cross_mount(src, dst):
+        # same st_dev, other mount point
+        if src.startswith(tmpdir+os.sep):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        return rename(src, dst)
+    try:
+        _, tmpfile = tempfile.mkstemp(dir=tmpdir)
+        dated = os.path.join(tmpdir, '20200101')
+        os.mkdir(dated)
+        _, datedfile = tempfile.mkstemp(dir=dated)
+        root_depth = len(tmpdir.split(os.sep))-1
+        with mock.patch('os.rename', side_effect=cross_mount):
+            result = archive([tmpfile, dated], dest, action='move', root_depth=root_depth)
+        assert result.errors == 0
+        assert not os.listdir(tmpdir)
+        assert os.path.exists(os.path.join(dest, os.path.basename(tmpfile)))
+        assert os.path.exists(os.path.join(dest, '20200101', os.path.basename(datedfile)))
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_archive_destination_cache():
+    tmpdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        files = [tempfile.mkstemp(dir=tmpdir)[1] for i in range(10)]
+        logger = mock.MagicMock()
+        with mock.patch('os.makedirs', wraps=os.makedirs) as makedirs:
+            archive(files, dest, action='copy', logger=logger)
+        assert makedirs.call_count == 1
+        logger.info.assert_any_call('Destination directories: 1, makedirs/stat '
+                                    'calls saved by cache: 18')
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(dest)
+
+def test_archive_directory_tree():
+    rootdir = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        recent, old = make_dated_tree(rootdir, days=(1, 5))
+        root_depth = len(rootdir.split(os.sep))-1
+        archive([old], dest, action='copy', root_depth=root_depth)
+        copied = os.path.join(dest, 'nz', os.path.basename(old), 'sub')
+        assert sorted(os.listdir(copied)) == ['roms_00z.nc', 'roms_12z.nc']
+        shutil.rmtree(os.path.join(dest, 'nz'))
+        with mock.patch('vacuum.utils.copy_file') as copy:
+            archive([old], dest, action='move', root_depth=root_depth)
+        copy.assert_not_called()
+        assert sorted(os.listdir(copied)) == ['roms_00z.nc', 'roms_12z.nc']
+        assert not os.path.exists(old)
+    finally:
+        shutil.rmtree(rootdir)
+        shutil.rmtree(dest)
+
 def test_archive_needs_action():
     tmpdir = tempfile.mkdtemp()
     try:
@@ -5,21 +5,56 @@ import six
 import time
 import datetime
 import yaml
+import json
+import hashlib
+import binascii
+import sqlite3
+import tarfile
+import zipfile
+import zlib
 import shutil
+import tempfile
+import stat
 import re
 import string
 import random
+import errno
 import logging
+import heapq
 import itertools
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as futures_wait
 
 import timeparser
 
 from os.path import *
-from glob import iglob
+from glob import iglob, has_magic
+
+try:
+    from os import scandir
+except ImportError: # python < 3.5
+    from scandir import scandir
+
+try:
+    import fcntl
+except ImportError: # not available on windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError: # optional, for tar.zst bundles
+    zstandard = None
+
+from six.moves import queue
 
-__all__ = ['flister', 'is_older_than', 'pastdt', 
-           'delete', 'path2dt',
-           'timestamp','archive','rand_chars']
+__all__ = ['flister', 'iscan', 'iscan_rules', 'ScanRule', 'PatternMatcher',
+           'is_older_than', 'pastdt', 
+           'delete', 'free_space_plan', 'quota_plan', 'parse_size', 'PlanReport',
+           'OperationResult', 'bundle', 'Bundle', 'path2dt', 'DateExtractor',
+           'timestamp','archive','copy_file','rand_chars']
 
 STRPTIME_RE = re.compile(r'\%[YymdHMSaAwbBIpfzZjUW]')
 
@@ -56,6 +91,151 @@ def strptime_re(strptime):
         strptime = re.sub(i, STPTIME_TO_RE[i], strptime)
     return re.compile(strptime)
 
+# Directives converted straight from the matched digits, any other directive
+# is parsed from the matched text with strptime
+STRPTIME_FIELDS = {
+    '%Y': 'year', '%y': 'year', '%m': 'month', '%d': 'day',
+    '%H': 'hour', '%M': 'minute', '%S': 'second', '%f': 'microsecond',
+}
+
+class StrptimeMatcher(object):
+    """
+    A strptime format compiled once into a RE with a named group for each
+    directive, finds the fields of the format in paths.
+
+    When the format can't span directories, the search on the directory
+    part of a path is memoized, so all files in a directory share it.
+    """
+    def __init__(self, strptime, cache_size=10000):
+        self.strptime = strptime
+        self.fields = []
+        pattern, position = [], 0
+        for i, found in enumerate(STRPTIME_RE.finditer(strptime)):
+            directive = found.group()
+            if directive not in STPTIME_TO_RE:
+                raise ValueError('Directive %s not supported in %s' %\
+                                                    (directive, strptime))
+            pattern.append(re.escape(strptime[position:found.start()]))
+            # STPTIME_TO_RE values are re.sub templates, expand them
+            pattern.append('(?P<f%d>%s)' % (i, re.sub('.*', STPTIME_TO_RE[directive], 
+                                                       '', count=1)))
+            self.fields.append(('f%d' % i, directive))
+            position = found.end()
+        pattern.append(re.escape(strptime[position:]))
+        self.regex = re.compile(''.join(pattern))
+        self.fast = all(directive in STRPTIME_FIELDS for _, directive in self.fields)
+        self.per_dir = sep not in strptime
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def _parse(self, text):
+        """
+        Returns a dict with the datetime fields found in text or None
+        """
+        found = self.regex.search(text)
+        if not found:
+            return None
+        if not self.fast:
+            try:
+                dt = datetime.datetime.strptime(found.group(), self.strptime)
+            except ValueError:
+                return None
+            return dict(year=dt.year, month=dt.month, day=dt.day, hour=dt.hour,
+                        minute=dt.minute, second=dt.second,
+                        microsecond=dt.microsecond)
+        values = {}
+        for group, directive in self.fields:
+            value = int(found.group(group))
+            if directive == '%y':
+                # same pivot as strptime
+                value += 2000 if value < 69 else 1900
+            values.setdefault(STRPTIME_FIELDS[directive], value)
+        return values
+
+    def search(self, filepath):
+        if not self.per_dir:
+            return self._parse(filepath)
+        dirpath, filename = split(filepath)
+        try:
+            found = self.cache[dirpath]
+        except KeyError:
+            found = self._parse(dirpath)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[dirpath] = found
+        return found if found is not None else self._parse(filename)
+
+class DateExtractor(object):
+    """
+    Compiled `date_strptime` and `time_strptime` of a rule, call it with a
+    path to get its datetime (see `path2dt`).
+    """
+    def __init__(self, date_strptime, time_strptime=None):
+        self.date = StrptimeMatcher(date_strptime)
+        self.time = StrptimeMatcher(time_strptime) if time_strptime else None
+
+    def _date(self, path):
+        found = self.date.search(path)
+        if found is None:
+            return None
+        try:
+            return datetime.datetime(found.get('year', 1900), found.get('month', 1),
+                                     found.get('day', 1), found.get('hour', 0),
+                                     found.get('minute', 0), found.get('second', 0),
+                                     found.get('microsecond', 0))
+        except ValueError:
+            return None
+
+    def _time(self, path):
+        found = self.time.search(path) if self.time else None
+        if found is None:
+            return None
+        try:
+            time_obj = datetime.time(found.get('hour', 0), found.get('minute', 0),
+                                     found.get('second', 0),
+                                     found.get('microsecond', 0))
+        except ValueError:
+            return None
+        return datetime.timedelta(hours=time_obj.hour, minutes=time_obj.minute,
+                                  seconds=time_obj.second,
+                                  microseconds=time_obj.microsecond)
+
+    def __call__(self, filepath):
+        date_obj = self._date(filepath)
+        if date_obj is None:
+            return None
+        return date_obj + (self._time(filepath) or datetime.timedelta(0))
+
+    def bounds(self, dirpath):
+        """
+        Range of the datetimes of every path under `dirpath`, from the date
+        (and time) found in it, or None when it can't be told.
+        """
+        if not self.date.per_dir or (self.time and not self.time.per_dir):
+            # a date spanning directories may start before `dirpath` ends
+            return None
+        date_obj = self._date(dirpath)
+        if date_obj is None:
+            return None
+        if self.time is None:
+            return date_obj, date_obj
+        delta = self._time(dirpath)
+        if delta is not None:
+            return date_obj+delta, date_obj+delta
+        # paths below can still add a time of the day
+        return date_obj, date_obj+datetime.timedelta(days=1)
+
+_extractors = {}
+
+def date_extractor(date_strptime, time_strptime=None):
+    """
+    Shared `DateExtractor` for a pair of formats
+    """
+    key = (date_strptime, time_strptime)
+    if key not in _extractors:
+        _extractors[key] = DateExtractor(date_strptime, time_strptime)
+    return _extractors[key]
+
 def path2dt(filepath, date_strptime, time_strptime=None):
     """
     Parse datetime from the filepath following some pre-defined search re and
@@ -65,20 +245,7 @@ def path2dt(filepath, date_strptime, time_strptime=None):
  
     return: datetime object if find date (and time) and None if no match
     """
-    finddate = strptime_re(date_strptime).search(filepath)
-    if finddate:
-        date_obj = datetime.datetime.strptime(finddate.group(), date_strptime)
-        if time_strptime:            
-            findtime = strptime_re(time_strptime).search(filepath)
-            if findtime:
-                time_obj = datetime.datetime.strptime(findtime.group(),
-                                                      time_strptime).time()
-                timedelta_obj = datetime.timedelta(hours=time_obj.hour,
-                                                   minutes=time_obj.minute,
-                                                   seconds=time_obj.second,
-                                                   microseconds=time_obj.microsecond)
-                date_obj = date_obj + timedelta_obj
-        return date_obj
+    return date_extractor(date_strptime, time_strptime)(filepath)
 
 def timestamp(dtobj):
     if six.PY2:
@@ -121,77 +288,716 @@ def str2re(patterns):
         compiled.append(re.compile(patt))
     return compiled
 
-   
+RE_META = set('.^$*+?{}[]\\|()')
+RE_QUANTIFIERS = set('*+?{')
+RE_BACKREF = re.compile(r'\\\d|\(\?P=')
+
+def _literal_affixes(pattern):
+    """
+    Literal prefix and suffix that any name matching `pattern` must have,
+    empty strings if they can't be safely told from the RE syntax.
+    """
+    if '|' in pattern or '(?' in pattern:
+        return '', ''
+    tokens = [] # literal characters, None for RE syntax
+    anchored = False
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            escaped = pattern[i+1:i+2]
+            if escaped == 'Z' and i+2 == len(pattern):
+                anchored = True
+            else:
+                tokens.append(escaped if escaped and not escaped.isalnum() else None)
+            i += 2
+            continue
+        elif char == '[':
+            # skip the whole character class
+            i += 1
+            if pattern[i:i+1] == '^':
+                i += 1
+            if pattern[i:i+1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            tokens.append(None)
+        elif char == '$' and i+1 == len(pattern):
+            anchored = True
+        elif char in RE_QUANTIFIERS:
+            # previous token is optional or repeated
+            if tokens:
+                tokens[-1] = None
+            tokens.append(None)
+            if char == '{':
+                i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+        elif char in RE_META:
+            tokens.append(None)
+        else:
+            tokens.append(char)
+        i += 1
+    end = tokens.index(None) if None in tokens else len(tokens)
+    prefix = ''.join(tokens[:end])
+    suffix = ''
+    if anchored:
+        start = len(tokens)
+        while start and tokens[start-1] is not None:
+            start -= 1
+        suffix = ''.join(tokens[start:])
+    return prefix, suffix
+
+class PatternMatcher(object):
+    """
+    Match names against a list of RE patterns at once, same as any of them
+    matching. Patterns are combined in a single alternation and literal
+    prefixes/suffixes required by all of them are tested before the RE.
+    """
+    def __init__(self, patterns):
+        compiled = str2re(patterns)
+        self.compiled = compiled
+        self.regex = compiled[0] if len(compiled) == 1 else self._combine(compiled)
+        affixes = [_literal_affixes(pattern.pattern) for pattern in compiled]
+        prefixes = tuple(prefix for prefix, suffix in affixes if prefix)
+        suffixes = tuple(suffix for prefix, suffix in affixes if suffix)
+        self.prefixes = prefixes if len(prefixes) == len(compiled) else None
+        self.suffixes = suffixes if len(suffixes) == len(compiled) else None
+        self.matches_all = any(pattern.pattern in ['', '.*', '.+'] 
+                               for pattern in compiled)
+
+    def _combine(self, compiled):
+        flags = re.compile('').flags
+        if any(pattern.flags != flags or RE_BACKREF.search(pattern.pattern)
+               for pattern in compiled):
+            return None
+        try:
+            return re.compile('|'.join('(?:%s)' % pattern.pattern 
+                                       for pattern in compiled))
+        except re.error:
+            return None
+
+    def match(self, name):
+        if self.prefixes and not name.startswith(self.prefixes):
+            return False
+        # `$` also matches before a trailing newline
+        if self.suffixes and not name.endswith(self.suffixes) and \
+           not name.endswith('\n'):
+            return False
+        if self.regex is None:
+            return any(pattern.match(name) for pattern in self.compiled)
+        return self.regex.match(name) is not None
+
+
+
+def _expand_rootdir(rootdir):
+    """
+    Expand a `rootdir` glob into the existing directories it matches
+    """
+    if has_magic(rootdir):
+        for dirpath in iglob(rootdir):
+            if isdir(dirpath):
+                yield dirpath
+    else:
+        yield rootdir
+
+class PathEntry(object):
+    """
+    ``DirEntry`` alike for paths not coming from a directory listing (scan
+    index, plans), the stat is only requested when needed if not given.
+    """
+    __slots__ = ['path', 'name', '_stat']
+
+    def __init__(self, path, stat=None):
+        self.path = path
+        self.name = basename(path)
+        self._stat = stat
+
+    def stat(self, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+        return self._stat
+
+def _entry_age(entry, dates=None):
+    """
+    Date in the path of a ``DirEntry`` (with a `DateExtractor`) or its mtime
+    from the entry cached stat, only requested if the path has no date.
+    """
+    mtime = None
+    if dates is not None:
+        mtime = dates(entry.path)
+    if mtime is None:
+        mtime = datetime.datetime.fromtimestamp(entry.stat().st_mtime)
+    return mtime
+
+def _entry_older_than(entry, than, dates=None):
+    """
+    Same as `is_older_than` but for a ``DirEntry`` and a `DateExtractor`
+    """
+    if than is None:
+        return True
+    try:
+        mtime = _entry_age(entry, dates)
+    except OSError:
+        return False
+    return True if mtime < than else False
+
+def iscan(rootdir=None, patterns=None, older_than=None, recursive=False, max_depth=-1,
+          depth=1, date_strptime=None, time_strptime=None, now=None, 
+          include_hidden=True, workers=1, dated_dirs=False,
+          **kwargs):
+    """
+    Scanning engine behind `flister`, generates the ``os.DirEntry`` of each
+    matching file instead of its path.
+
+    File type comes from the cached d_type of the directory listing and
+    mtime/size from a single (cached) ``entry.stat()``, so no extra syscalls
+    are needed per file. `rootdir` can be a glob matching directories.
+    With `workers` > 1 directories are listed by a pool of threads, so many
+    listings (and stats) are in flight at once.
+
+    With `dated_dirs` the date formats are also applied to directories: a
+    directory whose date is newer than `older_than` is not descended and,
+    when the rule takes every file (no patterns, hidden files and no
+    max_depth), an expired one is generated as a whole without listing it.
+    """
+    rule = ScanRule(rootdir, patterns, older_than, recursive, max_depth,
+                    date_strptime, time_strptime, now, include_hidden,
+                    dated_dirs)
+    roots = [(dirpath, [(0, rule, depth)]) for dirpath in _expand_rootdir(rule.rootdir)]
+    if workers > 1:
+        walk = _walk_rules_parallel(roots, None, workers)
+    else:
+        walk = itertools.chain(*[_walk_rules(dirpath, active, None)
+                                 for dirpath, active in roots])
+    for entry, indexes in walk:
+        yield entry
+
 def flister(rootdir=None, patterns=None, older_than=None, recursive=False, max_depth=-1,
             depth=1, date_strptime=None, time_strptime=None, now=None, 
-            include_hidden=True, **kwargs):
+            include_hidden=True, workers=1, dated_dirs=False,
+            **kwargs):
     """
     Genrates a list of files giving a `rootdir` and a 
     list of matching RE patterns. Also filters for files `older_than` than
     a period parseable by py-timeparser.
     """
-    rootdir = rootdir or abspath('.')
-    if not isinstance(patterns, (tuple,list)):
-        patterns = [patterns or '.+']
+    for entry in iscan(rootdir, patterns, older_than, recursive, max_depth,
+                       depth, date_strptime, time_strptime, now,
+                       include_hidden, workers, dated_dirs):
+        yield entry.path
+
+class ScanRule(object):
+    """
+    Compiled `flister` conditions of a single rule, used to evaluate many
+    rules over a single traversal (see `iscan_rules`)
+    """
+    def __init__(self, rootdir=None, patterns=None, older_than=None,
+                 recursive=False, max_depth=-1, date_strptime=None,
+                 time_strptime=None, now=None, include_hidden=True, 
+                 dated_dirs=False, max_total_size=None, target_free=None,
+                 target_free_bytes=None, **kwargs):
+        self.rootdir = rootdir or abspath('.')
+        if not isinstance(patterns, (tuple,list)):
+            patterns = [patterns or '.+']
+        self.matcher = PatternMatcher(patterns)
+        self.than = pastdt(older_than, now=now) if older_than is not None else None
+        self.recursive = recursive
+        self.max_depth = max_depth
+        self.dates = date_extractor(date_strptime, time_strptime) \
+                                            if date_strptime else None
+        self.include_hidden = include_hidden
+        self.dated_dirs = dated_dirs and self.dates is not None and \
+                          self.than is not None
+        # every file under a directory is accepted, if older. Size plans weigh
+        # files one by one, the directories are listed for them instead
+        self.takes_all = self.matcher.matches_all and include_hidden and \
+                         max_depth == -1 and max_total_size is None and \
+                         target_free is None and target_free_bytes is None
 
-    compiled = str2re(patterns)
+    def accepts(self, entry):
+        """
+        True for files matching patterns and older_than and for matching links
+        """
+        if not self.matcher.match(entry.name):
+            return False
+        if entry.is_file() and _entry_older_than(entry, self.than, self.dates):
+            return True
+        # links ignore older_than
+        return entry.is_symlink()
 
-    than = pastdt(older_than, now=now) if older_than is not None else None
+    def descends(self, depth):
+        return self.recursive and (self.max_depth == -1 or depth < self.max_depth)
 
-    if include_hidden:
-        all_files = itertools.chain(iglob(join(rootdir,'*')),
-                                    iglob(join(rootdir,'.*')))
-    else:
-        all_files = iglob(join(rootdir,'*'))
-
-    for filepath in all_files:
-        filename = basename(filepath)
-        for pattern in compiled:
-            if isfile(filepath) and pattern.match(filename) and \
-               is_older_than(filepath, than, date_strptime, time_strptime): 
-                yield filepath
-            elif islink(filepath) and pattern.match(filename):
-                # yield links that match pattern, links ignore older_than
-                yield filepath
-            elif isdir(filepath) and recursive and \
-                (max_depth == -1 or depth < max_depth):
-                i = 0
-                for filepath_ in flister(filepath, patterns, older_than, 
-                                        recursive, max_depth, 
-                                        depth+1,date_strptime,
-                                        time_strptime):
-                    yield filepath_
-                    i += 1
-                if i == 0 and exists(filepath) and not os.listdir(filepath):
-                    # empty dirs are yielded as well regardless of parameters
-                    yield filepath
-
-def delete(filelist, raise_errors=False, delete_empty=False, logger=logging, **kwargs):
-    """
-    Delete a list of files and directories
-    """
-    errors = {}
-    success_files, success_directories = [], []
-    basedirs = set()
-    for filepath in filelist:
+    def dir_age(self, entry):
+        """
+        With `dated_dirs`, tells from the date in a directory path if all
+        files under it are `expired` (then the rule accepts the directory as
+        a whole) or too `recent` (the directory is skipped), None otherwise.
+        """
+        if not self.dated_dirs:
+            return None
+        bounds = self.dates.bounds(entry.path)
+        if bounds is None:
+            return None
+        elif bounds[0] >= self.than:
+            return 'recent'
+        elif bounds[1] < self.than and self.takes_all and not entry.is_symlink():
+            return 'expired'
+
+def _dirkey(dirpath):
+    return tuple(normpath(abspath(dirpath)).split(sep))
+
+def _pending_within(pending, dirpath):
+    """
+    True if a rule root not reached yet is `dirpath` or lies under it
+    """
+    if not pending:
+        return False
+    key = _dirkey(dirpath)
+    return any(root[:len(key)] == key for root in list(pending))
+
+def _list_rules(dirpath, active, pending, direntry=None):
+    """
+    List `dirpath` for the rules scanning it, `active` is a list of (index,
+    rule, depth) and `pending` maps rule roots not reached yet to their
+    (index, rule) list.
+
+    Returns the accepted (entry, indexes) and the (dirpath, active, entry) of
+    sub-directories to descend into.
+    """
+    accepted, subdirs = [], []
+    try:
+        entries = list(scandir(dirpath))
+    except OSError:
+        return accepted, subdirs
+    if not entries:
+        # empty dirs are yielded for rules that recursed into them
+        indexes = [index for index, rule, depth in active if depth > 1]
+        if indexes and direntry is not None:
+            accepted.append((direntry, indexes))
+        return accepted, subdirs
+    for entry in entries:
+        hidden = entry.name.startswith('.')
+        indexes = []
+        subactive = []
+        whole = []
+        for index, rule, depth in active:
+            if hidden and not rule.include_hidden:
+                continue
+            if rule.accepts(entry):
+                indexes.append(index)
+            elif rule.descends(depth) and entry.is_dir():
+                age = rule.dir_age(entry)
+                if age == 'expired':
+                    whole.append((index, rule, depth+1))
+                elif age is None:
+                    subactive.append((index, rule, depth+1))
+        if pending and entry.is_dir():
+            # rules rooted deeper still have to list it
+            nested = _pending_within(pending, entry.path)
+            subactive.extend((index, rule, 1) for index, rule in
+                             pending.pop(_dirkey(entry.path), []))
+        else:
+            nested = False
+        if whole and (subactive or nested):
+            # taken whole, it would go under the rules listing it, so it is
+            # listed once for all of them instead
+            subactive.extend(whole)
+        else:
+            indexes.extend(index for index, rule, depth in whole)
+        if indexes:
+            accepted.append((entry, sorted(indexes)))
+        if subactive:
+            subdirs.append((entry.path, sorted(subactive, key=lambda item: item[0]),
+                            entry))
+    return accepted, subdirs
+
+def _walk_rules(dirpath, active, pending, direntry=None):
+    accepted, subdirs = _list_rules(dirpath, active, pending, direntry)
+    for item in accepted:
+        yield item
+    for subdir in subdirs:
+        for item in _walk_rules(subdir[0], subdir[1], pending, subdir[2]):
+            yield item
+
+def _walk_rules_parallel(roots, pending, workers):
+    """
+    Same as `_walk_rules` over several roots, but listing directories from a
+    shared queue with a pool of `workers` threads. Accepted entries are
+    generated as soon as their directory listing is done.
+    """
+    todo = collections.deque((dirpath, active, None) for dirpath, active in roots)
+    running = set()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while todo or running:
+            while todo and len(running) < 2*workers:
+                dirpath, active, direntry = todo.popleft()
+                running.add(executor.submit(_list_rules, dirpath, active,
+                                            pending, direntry))
+            done, running = futures_wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                accepted, subdirs = future.result()
+                todo.extend(subdirs)
+                for item in accepted:
+                    yield item
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def iscan_rules(rules, workers=1):
+    """
+    Evaluate several `ScanRule` over a single traversal per physical root.
+
+    Directories matched by more than one rule `rootdir` (or nested within
+    another rule tree) are only listed once, and an expired dated directory is
+    only taken as a whole if no other rule has to list it. Generates (entry,
+    indexes), where indexes are the positions in `rules` of every rule
+    accepting the entry.
+    With `workers` > 1 directories are listed in parallel threads and
+    entries are generated in no particular order.
+    """
+    pending, spelling = {}, {}
+    for index, rule in enumerate(rules):
+        for dirpath in _expand_rootdir(rule.rootdir):
+            key = _dirkey(dirpath)
+            # paths are generated with the first spelling found for a root
+            spelling.setdefault(key, dirpath)
+            pending.setdefault(key, []).append((index, rule))
+    while pending:
+        # Roots nested within other pending roots get attached while walking
+        # their parent instead of being listed twice
+        keys = [key for key in sorted(pending)
+                if not any(key[:i] in pending for i in range(1, len(key)))]
+        roots = [(spelling[key], [(index, rule, 1) for index, rule in pending.pop(key)])
+                 for key in keys]
+        if workers > 1:
+            walk = _walk_rules_parallel(roots, pending, workers)
+        else:
+            walk = itertools.chain(*[_walk_rules(dirpath, active, pending)
+                                     for dirpath, active in roots])
+        for item in walk:
+            yield item
+
+def _notifying(func, on_done):
+    def call(item):
         try:
-            if isdir(filepath):
-                shutil.rmtree(filepath)
-                logger.debug('Removed directory: %s' % filepath)
-                success_directories.append(filepath)
-            elif isfile(filepath) or lexists(filepath):
-                os.remove(filepath)
-                logger.debug('Deleted file: %s' % filepath)
-                success_files.append(filepath)
-            basedirs.update([dirname(filepath)])
-        except OSError as exc:
-            errors[filepath] = exc
+            result = func(item)
+        except Exception as exc:
+            on_done(item, exc)
+            raise
+        on_done(item, None)
+        return result
+    return call
+
+def _imap_bounded(func, items, workers=1, on_done=None):
+    """
+    Apply `func` to each of a stream of `items`, generating (item, result,
+    error) for OSErrors raised, as calls complete. With `workers` > 1 calls
+    run in a thread pool and at most 2*workers items are taken from the
+    stream ahead of them. `on_done(item, error)` is called as soon as each
+    call returns, from the thread that ran it.
+    """
+    if on_done is not None:
+        func = _notifying(func, on_done)
+    if workers <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except OSError as exc:
+                yield item, None, exc
+        return
+    items = iter(items)
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            for item in itertools.islice(items, 2*workers-len(running)):
+                running[executor.submit(func, item)] = item
+            if not running:
+                break
+            done, _ = futures_wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                exc = future.exception()
+                if exc is None:
+                    yield item, future.result(), None
+                elif isinstance(exc, OSError):
+                    yield item, None, exc
+                else:
+                    raise exc
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+class OperationResult(object):
+    """
+    Outcome of `delete` or `archive`: counts of files and directories done,
+    bytes of those files, of files skipped (already archived) and of errors,
+    of which only a sample of up to `max_errors` is kept. Paths done are only
+    kept with `keep_paths`.
+    """
+    __slots__ = ['files', 'directories', 'bytes', 'skipped', 'errors',
+                 'error_sample', 'max_errors', 'file_paths', 'directory_paths']
+
+    def __init__(self, keep_paths=False, max_errors=100):
+        self.files = 0
+        self.directories = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.errors = 0
+        self.error_sample = {}
+        self.max_errors = max_errors
+        self.file_paths = [] if keep_paths else None
+        self.directory_paths = [] if keep_paths else None
+
+    def add_file(self, path, size=0):
+        self.files += 1
+        self.bytes += size
+        if self.file_paths is not None:
+            self.file_paths.append(path)
+
+    def add_directory(self, path):
+        self.directories += 1
+        if self.directory_paths is not None:
+            self.directory_paths.append(path)
+
+    def add_error(self, path, exc):
+        self.errors += 1
+        if len(self.error_sample) < self.max_errors:
+            self.error_sample[path] = exc
+
+    def format_errors(self):
+        lines = ['%s: %s' % item for item in self.error_sample.items()]
+        if self.errors > len(self.error_sample):
+            lines.append('... and %d more' % (self.errors-len(self.error_sample)))
+        return os.linesep.join(lines)
+
+    def __str__(self):
+        return '%d file(s) (%d bytes) and %d directories, %d skipped, %d error(s)' %\
+                (self.files, self.bytes, self.directories, self.skipped, self.errors)
+
+def _delete_path(filepath, logger=logging):
+    st = os.lstat(filepath)
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(filepath)
+        logger.debug('Removed directory: %s' % filepath)
+        return 'directory', 0
+    os.remove(filepath)
+    logger.debug('Deleted file: %s' % filepath)
+    return 'file', st.st_size
+
+def delete(filelist, raise_errors=False, delete_empty=False, logger=logging, 
+           workers=1, rootdir=None, keep_paths=False, journal=None, on_done=None,
+           **kwargs):
+    """
+    Delete a list of files and directories, up to `workers` at once.
+    With `delete_empty` directories left empty are removed, up to `rootdir`.
+    Files deleted are committed to `journal` (a `RunJournal`) if given.
+    `on_done(path, error)` is called once each file is done with.
+    Returns an `OperationResult`, with paths deleted if `keep_paths`.
+    """
+    result = OperationResult(keep_paths)
+    pruner = DirPruner(rootdir, logger)
+    if on_done is not None:
+        report = on_done
+        def on_done(filepath, exc):
+            # already gone is not an error
+            if getattr(exc, 'errno', None) == errno.ENOENT:
+                exc = None
+            report(filepath, exc)
+    for filepath, removed, exc in _imap_bounded(lambda f: _delete_path(f, logger), 
+                                               filelist, workers, on_done):
+        if exc is not None:
+            if exc.errno != errno.ENOENT:
+                result.add_error(filepath, exc)
+            continue
+        kind, size = removed
+        if journal is not None:
+            journal.commit(filepath)
+        if kind == 'directory':
+            result.add_directory(filepath)
+        else:
+            result.add_file(filepath, size)
+        pruner.add(dirname(filepath))
+    # only once every file is gone
     if delete_empty:
-        success_directories.extend(remove_dir_if_empty(basedirs, logger))
-    message = 'Some files (%d) could not be deleted' % len(errors)
-    if errors and raise_errors:
+        for dirpath in pruner.prune():
+            result.add_directory(dirpath)
+    message = 'Some files (%d) could not be deleted' % result.errors
+    if result.errors and raise_errors:
         raise OSError(message)
-    return success_files, success_directories, errors
+    return result
+
+def bytes_to_free(path, target_free=None, target_free_bytes=None):
+    """
+    Bytes to free on the filesystem of `path` to have `target_free` (a
+    percentage of its size, i.e. '20%') or `target_free_bytes` available.
+    """
+    st = os.statvfs(path)
+    target = 0
+    if target_free is not None:
+        percent = float(str(target_free).rstrip('%'))
+        target = st.f_blocks*st.f_frsize*percent/100.
+    if target_free_bytes is not None:
+        target = max(target, int(target_free_bytes))
+    return int(target-st.f_bavail*st.f_frsize)
+
+def free_space_plan(entries, rootdir=None, target_free=None, target_free_bytes=None,
+                    dates=None, logger=logging):
+    """
+    Oldest of a stream of ``DirEntry`` objects whose removal frees the bytes
+    missing on the filesystem of `rootdir` to meet the target (see
+    `bytes_to_free`). Only those are kept (in a heap) while the stream goes
+    on, then generated oldest first until the target is met.
+    """
+    rootdir = next(iter(_expand_rootdir(rootdir or abspath('.'))), None)
+    if rootdir is None:
+        return
+    needed = bytes_to_free(rootdir, target_free, target_free_bytes)
+    if needed <= 0:
+        logger.info('Free space target already met on %s' % rootdir)
+        return
+    heap, total, counter = [], 0, itertools.count()
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+            if stat.S_ISDIR(st.st_mode):
+                continue
+            age = timestamp(_entry_age(entry, dates))
+        except OSError:
+            continue
+        # newest first out of the heap, as long as the others are enough
+        heapq.heappush(heap, (-age, next(counter), st.st_size, entry))
+        total += st.st_size
+        while total-heap[0][2] >= needed:
+            total -= heapq.heappop(heap)[2]
+    logger.info('%d file(s) (%d bytes) planned to free %d bytes on %s' %\
+                                        (len(heap), total, needed, rootdir))
+    for _, _, _, entry in sorted(heap, reverse=True):
+        if bytes_to_free(rootdir, target_free, target_free_bytes) <= 0:
+            logger.info('Free space target met on %s' % rootdir)
+            return
+        yield entry
+
+def entry_size(entry):
+    """ Size of a ``DirEntry`` (of the link itself for links), 0 if gone """
+    try:
+        return entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        return 0
+
+class PlanReport(object):
+    """
+    Running count and total bytes of the entries planned for a rule, logged
+    every `every` entries. With `output` (a file object, which may be shared
+    between rules) each entry is also written as a JSON line.
+    """
+    lock = threading.Lock()
+
+    def __init__(self, rule_id=None, operation=None, output=None, logger=logging,
+                 every=10000):
+        self.rule_id = rule_id
+        self.operation = operation
+        self.output = output
+        self.logger = logger
+        self.every = every
+        self.count = 0
+        self.size = 0
+
+    def __call__(self, entries):
+        for entry in entries:
+            size = entry_size(entry)
+            self.count += 1
+            self.size += size
+            if self.output is not None:
+                line = json.dumps(dict(rule=self.rule_id, operation=self.operation,
+                                       path=entry.path, size=size))
+                with self.lock:
+                    self.output.write(line+'\n')
+            yield entry
+            if self.count % self.every == 0:
+                self.logger.info('%s: %s' % (self.rule_id, self))
+
+    def __str__(self):
+        return '%d file(s), %d bytes' % (self.count, self.size)
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_size(size):
+    """
+    Bytes of a `size` given as a number or a string like '500M' or '10G'
+    """
+    if isinstance(size, six.integer_types+(float,)):
+        return int(size)
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(size), re.I)
+    if not match:
+        raise ValueError('Invalid size: %s' % size)
+    return int(float(match.group(1))*SIZE_UNITS[match.group(2).upper()])
+
+def _quota_cutoff(buckets, quota, kept):
+    """ Newest bucket which can't be kept whole and the bytes kept before it """
+    for bucket in sorted(buckets, reverse=True):
+        if kept+buckets[bucket] > quota:
+            return bucket, kept
+        kept += buckets[bucket]
+    return None, kept
+
+def quota_plan(entries, max_total_size, dates=None, logger=logging):
+    """
+    Entries of a stream of ``DirEntry`` objects beyond `max_total_size`,
+    keeping the newest ones. While the stream goes on entries are spilled to
+    a temporary file and bytes are summed per hour (of the date in the path or
+    of the mtime). Files of the boundary hour are spilled again and narrowed
+    down by minute then by second, so only bucket totals are held in memory.
+    """
+    quota = parse_size(max_total_size)
+    buckets = collections.defaultdict(int)
+    spill = tempfile.TemporaryFile('w+')
+    try:
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    continue
+                age = timestamp(_entry_age(entry, dates))
+            except OSError:
+                continue
+            buckets[int(age//3600)] += st.st_size
+            spill.write(json.dumps([age, st.st_size, entry.path])+'\n')
+        cutoff, kept = _quota_cutoff(buckets, quota, 0)
+        if cutoff is None:
+            logger.info('Total size (%d bytes) within quota (%d bytes)' % (kept, quota))
+            return
+        for width, narrower in [(3600, 60), (60, 1), (1, None)]:
+            spill.seek(0)
+            boundary = tempfile.TemporaryFile('w+') if narrower else None
+            buckets = collections.defaultdict(int)
+            for line in spill:
+                age, size, path = json.loads(line)
+                bucket = int(age//width)
+                if bucket < cutoff:
+                    yield PathEntry(path)
+                elif bucket == cutoff:
+                    if boundary is None:
+                        # within a second, in the order files were found
+                        kept += size
+                        if kept > quota:
+                            yield PathEntry(path)
+                        continue
+                    buckets[int(age//narrower)] += size
+                    boundary.write(line)
+            spill.close()
+            spill = boundary
+            if spill is None:
+                return
+            cutoff, kept = _quota_cutoff(buckets, quota, kept)
+            if cutoff is None:
+                return
+    finally:
+        if spill is not None:
+            spill.close()
 
 def maybe_create_dirs(path, logger=logging):
     try:
@@ -201,71 +1007,778 @@ def maybe_create_dirs(path, logger=logging):
         if exc.errno not in [17]:
             raise
 
+class DirPruner(object):
+    """
+    Remove the directories left empty by an operation, bottom-up and trying
+    each directory only once.
+
+    Directories of processed files are `add`-ed along the run. `prune` keeps
+    a count of pending children per directory and tries to remove each one
+    once all its children were tried, skipping parents of non-empty ones.
+    When `rootdir` (can be a glob) is given, ancestors up to the rule root
+    are pruned as well, short of the root itself.
+    """
+    def __init__(self, rootdir=None, logger=logging):
+        self.roots = set(_dirkey(dirpath) for dirpath in 
+                         _expand_rootdir(rootdir)) if rootdir else set()
+        self.dirs = set()
+        self.logger = logger
+
+    def add(self, dirpath):
+        self.dirs.add(dirpath)
+
+    def _with_ancestors(self):
+        dirs = set(self.dirs)
+        if not self.roots:
+            return dirs
+        for dirpath in self.dirs:
+            key = _dirkey(dirpath)
+            if not any(key[:i] in self.roots for i in range(1, len(key)+1)):
+                continue
+            while key not in self.roots:
+                dirpath, key = dirname(dirpath), key[:-1]
+                if key in self.roots or dirpath in dirs:
+                    break
+                dirs.add(dirpath)
+        return dirs
+
+    def prune(self):
+        """
+        Returns the list of removed directories
+        """
+        dirs = self._with_ancestors()
+        pending = collections.Counter(dirname(dirpath) for dirpath in dirs)
+        ready = [dirpath for dirpath in dirs if not pending[dirpath]]
+        blocked = set()
+        removed = []
+        while ready:
+            dirpath = ready.pop()
+            empty = False
+            # ignores root directories
+            if dirpath not in blocked and len(dirpath.split(sep)) > 2:
+                try:
+                    os.rmdir(dirpath)
+                    self.logger.debug('Removed empty-directory: %s' % dirpath)
+                    removed.append(dirpath)
+                    empty = True
+                except OSError as exc:
+                    if exc.errno == errno.ENOENT:
+                        empty = True
+                    elif exc.errno not in [errno.ENOTEMPTY, errno.EEXIST]:
+                        raise
+            parent = dirname(dirpath)
+            if parent in dirs and parent != dirpath:
+                if not empty:
+                    blocked.add(parent)
+                pending[parent] -= 1
+                if not pending[parent]:
+                    ready.append(parent)
+        return removed
+
 def remove_dir_if_empty(dirlist, logger=logging):
     """
     Try to remove empty directories from a list, ignores root directories.
     """
-    removed = []
-    for dirpath in sorted(list(dirlist), reverse=True):
-        if len(dirpath.split(sep)) > 2:
+    pruner = DirPruner(logger=logger)
+    for dirpath in dirlist:
+        pruner.add(dirpath)
+    return pruner.prune()
+
+# linux ioctl to clone (reflink) a file, from <linux/fs.h>
+FICLONE = 0x40049409
+
+# errors telling a kernel copy can't be done between two files
+NOCOPY_ERRNOS = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                     errno.EOPNOTSUPP, errno.EBADF])
+
+def _reflink(fsrc, fdst):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except (IOError, OSError) as exc:
+        if exc.errno in NOCOPY_ERRNOS:
+            return False
+        raise
+
+def _copy_file_range(fsrc, fdst):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    size = os.fstat(fsrc.fileno()).st_size
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 
+                                       min(size-copied, 2**30))
+            if count == 0:
+                break
+            copied += count
+    except OSError as exc:
+        if copied == 0 and exc.errno in NOCOPY_ERRNOS:
+            return False
+        raise
+    return copied > 0
+
+def copy_file(src, dst):
+    """
+    Copy file data and metadata (same as `shutil.copy2`) without going
+    through python buffers: clones the file (reflink) on filesystems
+    supporting it, else uses `os.copy_file_range` (a server side copy on
+    NFS >= 4.2), else `shutil.copyfile` which uses sendfile in python 3.8+.
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            copied = _reflink(fsrc, fdst) or _copy_file_range(fsrc, fdst)
+    if not copied:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+class DirCache(object):
+    """
+    Per-run cache of the destination directories known to exist, so their
+    `makedirs` and `stat` are only issued the first time they are seen.
+    """
+    def __init__(self, logger=logging):
+        self.logger = logger
+        self.stats = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def stat(self, dirpath):
+        """
+        Create `dirpath` if needed and return its stat
+        """
+        dir_stat = self.stats.get(dirpath)
+        if dir_stat is not None:
+            with self.lock:
+                self.hits += 1
+            return dir_stat
+        maybe_create_dirs(dirpath, self.logger)
+        dir_stat = os.stat(dirpath)
+        assert stat.S_ISDIR(dir_stat.st_mode)
+        self.stats[dirpath] = dir_stat
+        return dir_stat
+
+    @property
+    def saved_calls(self):
+        # makedirs and stat
+        return 2*self.hits
+
+def _file_digest(path, blocksize=1024*1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.digest()
+
+def _unchanged(src, src_stat, dst, compare='mtime'):
+    """
+    True if `dst` already is a copy of `src`: same size and mtime (kept by
+    copies) from a single stat or, with `compare` 'checksum', same size and
+    content hash.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    if not stat.S_ISREG(dst_stat.st_mode) or dst_stat.st_size != src_stat.st_size:
+        return False
+    elif compare == 'checksum':
+        return _file_digest(src) == _file_digest(dst)
+    return int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+
+class DedupStore(object):
+    """
+    Content-addressed store of archived files under `destination`, files with
+    the same content are hard links to a single object. Source digests are
+    cached in its sqlite file, keyed on path, size and mtime, so unchanged
+    sources are not hashed again by the next runs. Sources not cached are
+    read twice, once to be hashed before deciding to copy or link them.
+
+    Digests are committed every `commit_every` new ones. Rules archiving to
+    the same destination at once share its store (see `open`).
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, destination, logger=logging, commit_every=100, timeout=60):
+        self.root = join(destination, '.vacuum-store')
+        self.logger = logger
+        self.commit_every = commit_every
+        maybe_create_dirs(self.root, logger)
+        # other runs may write to it too
+        self.db = sqlite3.connect(join(self.root, 'digests.sqlite'), timeout=timeout,
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, '
+                        'size INTEGER, mtime REAL, digest TEXT)')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.users = 0
+        self.uncommitted = 0
+        self.hashed = 0
+        self.cached = 0
+        self.saved = 0
+
+    @classmethod
+    def open(cls, destination, logger=logging):
+        """ Store of `destination`, shared until each user `close`-s it """
+        key = realpath(destination)
+        with cls._shared_lock:
+            store = cls._shared.get(key)
+            if store is None:
+                store = cls._shared[key] = cls(destination, logger)
+            store.users += 1
+        return store
+
+    def digest(self, src, src_stat):
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, digest FROM digests WHERE '
+                                  'path = ?', (src,)).fetchone()
+            if row and tuple(row[:2]) == (src_stat.st_size, src_stat.st_mtime):
+                self.cached += 1
+                return row[2]
+        digest = binascii.hexlify(_file_digest(src)).decode('ascii')
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+                            (src, src_stat.st_size, src_stat.st_mtime, digest))
+            self.hashed += 1
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                # short write transactions, kept if the run is killed
+                self.db.commit()
+                self.uncommitted = 0
+        return digest
+
+    def _object(self, digest):
+        return join(self.root, digest[:2], digest)
+
+    def link(self, digest, dst, size=0):
+        """ Hard link the object of `digest` at `dst`, False if not stored """
+        try:
+            os.link(self._object(digest), dst)
+        except OSError as exc:
+            # not stored yet, another filesystem or too many links
+            if exc.errno in [errno.ENOENT, errno.EXDEV, errno.EMLINK]:
+                return False
+            raise
+        with self.lock:
+            self.saved += size
+        return True
+
+    def add(self, digest, path):
+        obj = self._object(digest)
+        for retry in [True, False]:
             try:
-                os.rmdir(dirpath)
-                logger.debug('Removed empty-directory: %s' % dirpath)
-                removed.append(dirpath)
+                os.link(path, obj)
+                return
             except OSError as exc:
-                if exc.errno == 39:
-                    pass
-                else:
+                if exc.errno == errno.ENOENT and retry:
+                    maybe_create_dirs(dirname(obj))
+                elif exc.errno not in [errno.EEXIST, errno.EXDEV, errno.EMLINK]:
                     raise
-    return removed
+                else:
+                    return
+
+    def prune(self):
+        """
+        Remove the objects no archived file links to anymore (i.e. removed by a
+        retention rule), returns the number of objects and bytes freed.
+        """
+        removed, freed = 0, 0
+        for subdir in scandir(self.root):
+            if not subdir.is_dir(follow_symlinks=False):
+                continue
+            for entry in scandir(subdir.path):
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+                    os.remove(entry.path)
+                    removed += 1
+                    freed += st.st_size
+        return removed, freed
+
+    def close(self):
+        with self._shared_lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            key = realpath(dirname(self.root))
+            if self._shared.get(key) is self:
+                del self._shared[key]
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+def _rename_within_device(src, dst):
+    """
+    Rename `src` on the device of `dst`, False if they are on different mount
+    points of it (i.e. bind mounts) and it must be copied instead.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        return False
+    return True
+
+def _archive_tree(src, final_dir, src_stat, dest_stat, destination, action,
+                  root_depth=0, logger=logging, dircache=None, journal=None,
+                  compare=None, dedup=None):
+    """
+    Archive a whole directory, i.e. an expired dated directory. Moving it
+    within a device with its tree preserved is a single rename, otherwise
+    files under it are archived one by one.
+    """
+    if action == 'move' and root_depth and len(src.split(os.sep)) > root_depth+1 \
+       and src_stat.st_dev == dest_stat.st_dev and not lexists(final_dir) and \
+       _rename_within_device(src, final_dir):
+        logger.debug('Moved directory: %s to %s' % (src, dirname(final_dir)))
+        return 'renamed', 0
+    for dirpath, dirnames, filenames in os.walk(src):
+        links = [name for name in dirnames if islink(join(dirpath, name))]
+        for name in filenames+links:
+            _archive_path(join(dirpath, name), destination, action, root_depth,
+                          logger, dircache, journal, compare, dedup)
+    if action == 'move':
+        for dirpath, dirnames, filenames in os.walk(src, topdown=False):
+            os.rmdir(dirpath)
+        logger.debug('Deleted source directory: %s' % src)
+    return 'tree', 0
+
+def _archive_path(src, destination, action, root_depth=0, logger=logging,
+                  dircache=None, journal=None, compare=None, dedup=None):
+    """
+    Archive a single file, returns how it was done: `renamed` (a move within
+    the same device), `copied`, `deduplicated` (hard linked from a
+    `DedupStore`), `skipped` (already at destination, see `_unchanged`),
+    `linked` (symbolic links are re-created) or `tree` (a directory archived
+    file by file), and the bytes archived.
+    """
+    if root_depth:
+        branch = dirname(src.split(os.sep, root_depth+1)[-1])
+        final_destination = join(destination, branch)
+    else:
+        branch = dirname(src)
+        final_destination = destination
+    dircache = dircache or DirCache(logger)
+    dest_stat = dircache.stat(final_destination)
+    filename = basename(src)
+    tmp_file = join(final_destination, filename+'.'+rand_chars())
+    final_file = join(final_destination, filename)
+    src_stat = os.lstat(src)
+    how = None
+    if stat.S_ISLNK(src_stat.st_mode):
+        if islink(final_file):
+            logger.debug('Overwriting link at: %s ...' % (final_file))
+            os.remove(final_file)
+        src_link = os.readlink(src)
+        os.symlink(src_link, final_file)
+        logger.debug('Copied link: %s to %s --> %s' % (src, final_file, src_link))
+        how = 'linked'
+    elif stat.S_ISREG(src_stat.st_mode):
+        # same filesystem, an atomic rename replaces any existing file
+        if action == 'move' and src_stat.st_dev == dest_stat.st_dev and \
+           _rename_within_device(src, final_file):
+            logger.debug('Moved file: %s to %s' % (src, dirname(final_file)))
+            return 'renamed', src_stat.st_size
+        if compare and _unchanged(src, src_stat, final_file, compare):
+            logger.debug('Unchanged at destination, skipped: %s' % src)
+            how = 'skipped'
+        else:
+            if journal is not None:
+                journal.temp(tmp_file)
+            try:
+                digest = dedup.digest(src, src_stat) if dedup is not None else None
+                if digest is not None and dedup.link(digest, tmp_file, src_stat.st_size):
+                    how = 'deduplicated'
+                else:
+                    copy_file(src, tmp_file)
+                    if digest is not None:
+                        dedup.add(digest, tmp_file)
+                    how = 'copied'
+            except Exception:
+                if lexists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+            if exists(final_file):
+                logger.debug('Overwriting file at: %s ...' % (final_file))
+                os.remove(final_file)
+            logger.debug('%s file: %s to %s' % (how.title(), src, dirname(final_file)))
+            os.rename(tmp_file, final_file)
+    elif stat.S_ISDIR(src_stat.st_mode):
+        return _archive_tree(src, final_file, src_stat, dest_stat, destination,
+                             action, root_depth, logger, dircache, journal,
+                             compare, dedup)
+    if action == 'move' and exists(final_file):
+        os.remove(src)
+        logger.debug('Deleted source file: %s' % src)
+    return how, src_stat.st_size if how in ['copied', 'deduplicated'] else 0
 
 def archive(filelist, destination, action, root_depth=0, raise_errors=False, 
-            delete_empty=False, logger=logging, **kwargs):
+            delete_empty=False, logger=logging, workers=1, rootdir=None,
+            keep_paths=False, journal=None, compare=None, format=None,
+            dedup=False, on_done=None, **kwargs):
+    """
+    Copy (or move) a list of files into `destination`, up to `workers` at once.
+    With `compare` ('mtime' or 'checksum') files already at destination are
+    not copied again, with `dedup` files already archived elsewhere in
+    `destination` are hard linked (see `DedupStore`). With `delete_empty`
+    directories left empty are removed, up to `rootdir`. With a bundle
+    `format` files go to bundles instead (see `bundle`).
+    Temporary copies and files archived are recorded in `journal` if given.
+    `on_done(path, error)` is called once each file is done with.
+    Returns an `OperationResult`, with paths archived if `keep_paths`.
+    """
     assert action in ['copy','move'], "action must be either `copy` or `move`, not %s" % str(action)
-    errors = {}
-    success_files, success_directories = [], []
-    basedirs = set()
-    for src in filelist:
+    if format:
+        return bundle(filelist, destination, format, action, root_depth=root_depth,
+                      raise_errors=raise_errors, delete_empty=delete_empty,
+                      logger=logger, rootdir=rootdir, keep_paths=keep_paths,
+                      journal=journal, on_done=on_done, **kwargs)
+    result = OperationResult(keep_paths)
+    pruner = DirPruner(rootdir, logger)
+    archived = collections.Counter()
+    dircache = DirCache(logger)
+    store = DedupStore.open(destination, logger) if dedup else None
+    archive_path = lambda src: _archive_path(src, destination, action, 
+                                             root_depth, logger, dircache,
+                                             journal, compare, store)
+    for src, done, exc in _imap_bounded(archive_path, filelist, workers, on_done):
+        if exc is not None:
+            result.add_error(src, exc)
+            continue
+        how, size = done
+        if journal is not None:
+            journal.commit(src)
+        archived[how] += 1
+        if how == 'skipped':
+            result.skipped += 1
+        else:
+            result.add_file(src, size)
+        pruner.add(dirname(src))
+    if delete_empty:
+        for dirpath in pruner.prune():
+            result.add_directory(dirpath)
+
+    logger.info('Archived %d file(s): %d renamed (same device), %d copied, '
+                '%d deduplicated, %d link(s) re-created, %d directory tree(s)' %\
+                (sum(archived.values())-archived['skipped'], archived['renamed'],
+                 archived['copied'], archived['deduplicated'], archived['linked'],
+                 archived['tree']))
+    if compare:
+        logger.info('Skipped %d file(s) unchanged at destination (%s)' %\
+                                                (archived['skipped'], compare))
+    if store is not None:
+        pruned, freed = store.prune()
+        store.close()
+        logger.info('Deduplicated %d file(s) (%d bytes not written), %d file(s) '
+                    'hashed, %d digest(s) from cache' % (archived['deduplicated'],
+                                        store.saved, store.hashed, store.cached))
+        logger.info('Removed %d unlinked object(s) (%d bytes) from the store' %\
+                                                                (pruned, freed))
+    logger.info('Destination directories: %d, makedirs/stat calls saved by '
+                'cache: %d' % (len(dircache.stats), dircache.saved_calls))
+    if result.errors:
+        message = '%d file(s) could not be archived' % result.errors
+        logger.error('%s: %s%s' % (message, os.linesep, result.format_errors()))
+        if raise_errors:
+            raise Exception(message)
+    return result
+
+BUNDLE_FORMATS = ['tar', 'tar.gz', 'tar.zst', 'zip']
+
+def _compressor(format):
+    if format == 'tar.gz':
+        # gzip container
+        return zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    elif format == 'tar.zst':
+        if zstandard is None:
+            raise ImportError('tar.zst bundles need the zstandard package')
+        return zstandard.ZstdCompressor().compressobj()
+
+class _CompressingPipe(object):
+    """
+    Write-only file object handing blocks to a thread which compresses them
+    and writes them to `fileobj`, so reading files and compressing overlap.
+    """
+    def __init__(self, fileobj, compressor=None, maxsize=64):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    if self.compressor is not None:
+                        self.fileobj.write(self.compressor.flush())
+                    return
+                if self.compressor is not None:
+                    data = self.compressor.compress(data)
+                self.fileobj.write(data)
+        except Exception as exc:
+            self.error = exc
+            # unblock writers
+            while self.queue.get() is not None:
+                pass
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(bytes(data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+class Bundle(object):
+    """
+    Bundle of archived files written to a temporary file next to `path`, only
+    renamed to `path` once closed and verified against the index of its
+    members (`path`.index, a JSON line per member with its source).
+    """
+    def __init__(self, path, format, logger=logging, journal=None):
+        assert format in BUNDLE_FORMATS, "format must be one of %s, not %s" %\
+                                                    (BUNDLE_FORMATS, format)
+        self.path = path
+        self.format = format
+        self.logger = logger
+        self.tmp_path = path+'.'+rand_chars()
+        self.tmp_index = self.tmp_path+'.index'
+        if journal is not None:
+            journal.temp(self.tmp_path)
+            journal.temp(self.tmp_index)
+        self.fileobj = open(self.tmp_path, 'wb')
+        self.index = open(self.tmp_index, 'w')
+        self.pipe = None
+        self.failed = set()
+        if format == 'zip':
+            self.bundle = zipfile.ZipFile(self.fileobj, 'w', zipfile.ZIP_DEFLATED,
+                                          allowZip64=True)
+        else:
+            self.pipe = _CompressingPipe(self.fileobj, _compressor(format))
+            self.bundle = tarfile.open(fileobj=self.pipe, mode='w|')
+
+    def _record(self, name, size, src):
+        self.index.write(json.dumps(dict(name=name, size=size, source=src))+'\n')
+
+    def add(self, src, arcname):
+        """
+        Add a file, link or directory (with its tree), returns the bytes added.
+        Members are only indexed once written: if one can't be read, `src` is
+        left out of `sources` (members of it already written stay).
+        """
+        paths = [(src, arcname)]
+        if isdir(src) and not islink(src):
+            for dirpath, dirnames, filenames in os.walk(src):
+                for name in sorted(dirnames)+sorted(filenames):
+                    path = join(dirpath, name)
+                    paths.append((path, join(arcname, relpath(path, src))))
+        added = 0
         try:
-            if root_depth:
-                branch = dirname(src.split(os.sep, root_depth+1)[-1])
-                final_destination = join(destination, branch)
+            for path, name in paths:
+                added += self._add_member(path, name, src)
+        except (OSError, IOError):
+            self.failed.add(src)
+            raise
+        return added
+
+    def _add_member(self, path, name, src):
+        if self.format == 'zip':
+            self.bundle.write(path, name)
+            info = self.bundle.infolist()[-1]
+            name, size = info.filename.rstrip('/'), info.file_size
+        else:
+            tarinfo = self.bundle.gettarinfo(path, name)
+            if tarinfo is None:
+                # sockets and the like
+                return 0
+            if tarinfo.isreg():
+                # opened first, a source that can't be read is not half added
+                with open(path, 'rb') as f:
+                    self.bundle.addfile(tarinfo, f)
             else:
-                branch = dirname(src)
-                final_destination = destination
-            maybe_create_dirs(final_destination)
-            assert isdir(final_destination)
-            filename = basename(src)
-            tmp_file = join(final_destination, filename+'.'+rand_chars())
-            final_file = join(final_destination, filename)
-            if islink(src):
-                if islink(final_file):
-                    logger.debug('Overwriting link at: %s ...' % (final_file))
-                    os.remove(final_file)
-                src_link = os.readlink(src)
-                os.symlink(src_link, final_file)
-                logger.debug('Copied link: %s to %s --> %s' % (src, final_file, src_link))
-            elif isfile(src):
-                shutil.copy2(src, tmp_file)
-                if exists(final_file):
-                    logger.debug('Overwriting file at: %s ...' % (final_file))
-                    os.remove(final_file)
-                logger.debug('Copied file: %s to %s' % (src, dirname(final_file)))
-                os.rename(tmp_file, final_file)
-            if action == 'move' and exists(final_file):
-                os.remove(src)
-                logger.debug('Deleted source file: %s' % src)
-            success_files.append(src)
-            basedirs.update([dirname(src)])
-            if delete_empty:
-                success_directories.extend(remove_dir_if_empty(basedirs, logger))
-        except OSError as exc:
-            errors[src] = exc
-    
-    if errors:
-        message = '%d file(s) could not be archived' % len(errors)
-        logger.error('%s: %s%s' % (message, os.linesep, 
-                 os.linesep.join(['%s: %s' % (k,v) for k,v in errors.items()])))
+                self.bundle.addfile(tarinfo)
+            name, size = tarinfo.name, tarinfo.size
+        self._record(name, size, src)
+        return size
+
+    def close(self):
+        self.bundle.close()
+        if self.pipe is not None:
+            self.pipe.close()
+        self.index.close()
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        self.fileobj.close()
+
+    def _members(self):
+        if self.format == 'zip':
+            with zipfile.ZipFile(self.tmp_path) as bundle:
+                bad = bundle.testzip()
+                if bad is not None:
+                    raise zipfile.BadZipfile('Bad CRC for %s' % bad)
+                for info in bundle.infolist():
+                    yield info.filename.rstrip('/'), info.file_size
+            return
+        with open(self.tmp_path, 'rb') as f:
+            if self.format == 'tar.zst':
+                f = zstandard.ZstdDecompressor().stream_reader(f)
+                mode = 'r|'
+            else:
+                mode = 'r|gz' if self.format == 'tar.gz' else 'r|'
+            with tarfile.open(fileobj=f, mode=mode) as bundle:
+                for tarinfo in bundle:
+                    if tarinfo.isreg():
+                        # read through, checking compressed data
+                        member = bundle.extractfile(tarinfo)
+                        while member.read(1024*1024):
+                            pass
+                    yield tarinfo.name, tarinfo.size
+
+    def verify(self):
+        """ Read the bundle back, its members must be the ones indexed """
+        with open(self.tmp_index) as index:
+            expected = ((m['name'], m['size']) for m in map(json.loads, index))
+            for member, indexed in six.moves.zip_longest(self._members(), expected):
+                if member != indexed:
+                    raise tarfile.TarError('Bundle %s does not match its index '
+                                           '(%s vs %s)' % (self.path, member, indexed))
+
+    def commit(self):
+        os.rename(self.tmp_index, self.path+'.index')
+        os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        if not self.fileobj.closed:
+            try:
+                self.close()
+            except Exception:
+                self.index.close()
+                self.fileobj.close()
+        for path in [self.tmp_path, self.tmp_index]:
+            if lexists(path):
+                os.remove(path)
+
+    def sources(self):
+        """ Sources of the members and their bytes, once committed """
+        source, size = None, 0
+        with open(self.path+'.index') as index:
+            for member in map(json.loads, index):
+                if member['source'] in self.failed:
+                    continue
+                if member['source'] != source:
+                    if source is not None:
+                        yield source, size
+                    source, size = member['source'], 0
+                size += member['size']
+        if source is not None:
+            yield source, size
+
+def _finish_bundle(current, action, result, pruner, logger=logging, journal=None):
+    """
+    Close, verify and commit a `Bundle`, then account for (and with `move`
+    remove) its sources. A bundle which can't be verified is discarded.
+    """
+    try:
+        current.close()
+        current.verify()
+        current.commit()
+    except Exception as exc:
+        current.discard()
+        result.add_error(current.path, exc)
+        return
+    logger.info('Bundle written and verified: %s' % current.path)
+    for src, size in current.sources():
+        if journal is not None:
+            journal.commit(src)
+        if action == 'move':
+            try:
+                _delete_path(src, logger)
+            except OSError as exc:
+                result.add_error(src, exc)
+                continue
+            pruner.add(dirname(src))
+        result.add_file(src, size)
+
+def bundle(filelist, destination, format='tar.gz', action='copy', root_depth=0,
+           bundle_by='rule', bundle_name=None, raise_errors=False,
+           delete_empty=False, logger=logging, rootdir=None, keep_paths=False,
+           journal=None, on_done=None, max_open=8, **kwargs):
+    """
+    Archive a list of files into `format` bundles in `destination`, a single
+    one per rule (named `bundle_name`, by default after the current time) or,
+    with `bundle_by` 'directory', one per source directory (i.e. per date
+    directory). Members keep the tree after `root_depth`. With `move`, sources
+    are only removed once their bundle is closed and verified. `on_done(path,
+    error)` is called once each file is read into its bundle.
+
+    Files come a directory after the other (see `iscan_rules`), so a bundle is
+    finished as soon as the next one starts. Once a directory shows up again
+    (parallel scans) up to `max_open` bundles are kept open instead, the least
+    recently used finished first, and a directory showing up once its bundle
+    is finished gets a new one (part).
+    """
+    bundle_name = bundle_name or 'vacuum-%s' % datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    extension = '.'+format
+    result = OperationResult(keep_paths)
+    pruner = DirPruner(rootdir, logger)
+    # open bundles, least recently used first
+    bundles = collections.OrderedDict()
+    finished = set()
+    ordered = True
+    finish = lambda current: _finish_bundle(current, action, result, pruner, logger,
+                                            journal)
+    try:
+        for src in filelist:
+            tree = src.split(os.sep, root_depth+1)[-1] if root_depth else src
+            arcname = tree.lstrip(os.sep)
+            if bundle_by == 'directory':
+                key = dirname(arcname) or bundle_name
+                arcname = basename(arcname)
+            else:
+                key = bundle_name
+            error = None
+            try:
+                if key in bundles:
+                    bundles[key] = bundles.pop(key)
+                else:
+                    if key in finished:
+                        ordered = False
+                    while bundles and (ordered or len(bundles) >= max_open):
+                        finished.add(next(iter(bundles)))
+                        finish(bundles.popitem(last=False)[1])
+                    path = join(destination, key+extension)
+                    maybe_create_dirs(dirname(path), logger)
+                    if lexists(path):
+                        path = join(destination, '%s.%s%s' % (key, rand_chars(), extension))
+                    bundles[key] = Bundle(path, format, logger, journal)
+                bundles[key].add(src, arcname)
+            except (OSError, IOError) as exc:
+                result.add_error(src, exc)
+                error = exc
+            if on_done is not None:
+                on_done(src, error)
+        while bundles:
+            finish(bundles.popitem(last=False)[1])
+    finally:
+        for current in bundles.values():
+            current.discard()
+    if delete_empty:
+        for dirpath in pruner.prune():
+            result.add_directory(dirpath)
+    logger.info('Bundled %s' % result)
+    if result.errors:
+        message = '%d file(s) could not be archived' % result.errors
+        logger.error('%s: %s%s' % (message, os.linesep, result.format_errors()))
         if raise_errors:
             raise Exception(message)
-    return success_files, success_directories, errors
+    return result